@@ -1,7 +1,7 @@
 import sys
 import boto3
 from botocore.exceptions import ClientError
-import requests
+import responder_lib as RL
 
 # Configuration
 CONFIG = {'config': {'url': 'http://config.int.janelia.org/'}}
@@ -11,11 +11,11 @@ BUCKET = 'janelia-flylight-imagery'
 
 
 def call_responder(server, endpoint):
-    url = (CONFIG[server]['url'] if server else '') + endpoint
-    req = requests.get(url)
-    if req.status_code == 200:
-        return req.json()
-    sys.exit(-1)
+    try:
+        return RL.call_responder(CONFIG, server, endpoint)
+    except RL.ResponderError as err:
+        print(err)
+        sys.exit(-1)
 
 
 def initialize():
@@ -0,0 +1,541 @@
+''' benchmark_upload_cdms.py
+    Offline throughput benchmark for upload_cdms.py. Each scenario runs upload_cdms
+    in a separate process against local stand-ins:
+      S3: an in-process emulator (LocalS3) that reads and hashes each upload
+      SAGE: an SQLite database with image_data_mv and line_property_vw tables
+      config and jacsv2: a stub HTTP server (started by this program)
+    Synthetic NeuronBridge JSON and CDM PNG/TIFF fixtures are generated in the work
+    directory. For each scenario, samples/sec, bytes/sec and peak RSS are reported.
+    Use --output to save the results and --baseline to compare with saved results.
+'''
+
+import argparse
+import hashlib
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import io
+import json
+import os
+import random
+import re
+import resource
+import runpy
+import shutil
+import sqlite3
+import subprocess
+import sys
+import tempfile
+import threading
+from time import sleep, time
+import colorlog
+import boto3
+from botocore.exceptions import ClientError
+import inquirer
+import jwt
+import MySQLdb
+from PIL import Image, ImageDraw
+
+__version__ = '1.0.0'
+# Fixed scenarios: library type, default sample count, and upload_cdms arguments
+SCENARIOS = {'light': {'type': 'flylight', 'samples': 200, 'args': []},
+             'light-workers': {'type': 'flylight', 'samples': 200,
+                               'args': ['--workers', '8']},
+             'light-stream': {'type': 'flylight', 'samples': 200,
+                              'args': ['--workers', '8', '--stream', '--pushdown',
+                                       '--plan-pass']},
+             'flyem': {'type': 'flyem', 'samples': 100, 'args': []},
+             'flyem-processes': {'type': 'flyem', 'samples': 100,
+                                 'args': ['--workers', '8', '--processes', '0']},
+             'flyem-memory': {'type': 'flyem', 'samples': 100,
+                              'args': ['--workers', '8', '--processes', '0', '--in-memory']}}
+LIBRARY = {'flylight': 'flylight_bench', 'flyem': 'flyem_bench'}
+ALIGNMENT_SPACE = 'JRC2018_Unisex_20x_HR'
+VARIANTS = ['gradient', 'searchable_neurons', 'zgap']
+DRIVERS = ['GAL4_Collection', 'LexA', 'Split_GAL4']
+UPLOAD_CDMS = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'upload_cdms.py')
+
+
+class LocalS3:
+    ''' In-process S3 emulator. Uploaded data is read and hashed (like a real
+        upload) but only object sizes and ETags are kept.
+    '''
+
+    def __init__(self, latency=0):
+        self.latency = latency
+        self.objects = dict()
+        self.uploaded = {'objects': 0, 'bytes': 0}
+        self.lock = threading.Lock()
+
+    def _store(self, fileobj, bucket, key):
+        md5 = hashlib.md5()
+        size = 0
+        for data in iter(lambda: fileobj.read(8 * 1024 * 1024), b''):
+            md5.update(data)
+            size += len(data)
+        if self.latency:
+            sleep(self.latency)
+        with self.lock:
+            self.objects[(bucket, key)] = {'Key': key, 'Size': size,
+                                           'ETag': '"%s"' % (md5.hexdigest())}
+            self.uploaded['objects'] += 1
+            self.uploaded['bytes'] += size
+
+    def upload_file(self, filename, bucket, key, **_):
+        ''' Emulate S3.Client.upload_file '''
+        with open(filename, 'rb') as sfile:
+            self._store(sfile, bucket, key)
+
+    def upload_fileobj(self, fileobj, bucket, key, **_):
+        ''' Emulate S3.Client.upload_fileobj '''
+        self._store(fileobj, bucket, key)
+
+    def put_object(self, Bucket, Key, Body=b'', **_): # pylint: disable=invalid-name
+        ''' Emulate S3.Client.put_object '''
+        self._store(io_reader(Body), Bucket, Key)
+
+    def head_object(self, Bucket, Key, **_): # pylint: disable=invalid-name
+        ''' Emulate S3.Client.head_object '''
+        with self.lock:
+            obj = self.objects.get((Bucket, Key))
+        if not obj:
+            raise ClientError({'Error': {'Code': '404', 'Message': 'Not Found'}}, 'HeadObject')
+        return {'ContentLength': obj['Size'], 'ETag': obj['ETag']}
+
+    def list_objects_v2(self, Bucket, Prefix='', MaxKeys=1000, # pylint: disable=invalid-name
+                        ContinuationToken='', **_):
+        ''' Emulate S3.Client.list_objects_v2 '''
+        with self.lock:
+            keys = sorted(key for bucket, key in self.objects
+                          if bucket == Bucket and key.startswith(Prefix)
+                          and key > ContinuationToken)
+            contents = [dict(self.objects[(Bucket, key)]) for key in keys[:MaxKeys]]
+        resp = {'KeyCount': len(contents), 'IsTruncated': len(keys) > MaxKeys}
+        if contents:
+            resp['Contents'] = contents
+        if resp['IsTruncated']:
+            resp['NextContinuationToken'] = contents[-1]['Key']
+        return resp
+
+
+def io_reader(body):
+    ''' Return a binary file object for a put_object body
+        Keyword arguments:
+          body: bytes, string, or file object
+        Returns:
+          file object
+    '''
+    if isinstance(body, str):
+        body = body.encode()
+    return io.BytesIO(body) if isinstance(body, bytes) else body
+
+
+class SageCursor:
+    ''' MySQLdb-style cursor for the SQLite SAGE stand-in '''
+
+    def __init__(self, conn):
+        self.cursor = conn.cursor()
+        self.description = None
+
+    def execute(self, stmt, args=None):
+        ''' Run a MySQL statement on SQLite. Table status queries return an unknown
+            update time, so the mapping cache always refreshes.
+        '''
+        if 'information_schema' in stmt:
+            self.cursor.execute("SELECT NULL,NULL")
+        else:
+            self.cursor.execute(stmt.replace('%s', '?'), tuple(args) if args else ())
+        self.description = self.cursor.description
+
+    def fetchone(self):
+        ''' Fetch one row '''
+        return self.cursor.fetchone()
+
+    def fetchmany(self, size=1):
+        ''' Fetch some rows '''
+        return self.cursor.fetchmany(size)
+
+    def fetchall(self):
+        ''' Fetch all rows '''
+        return self.cursor.fetchall()
+
+    def __iter__(self):
+        return iter(self.cursor)
+
+
+class SageConnection:
+    ''' MySQLdb-style connection for the SQLite SAGE stand-in '''
+
+    def __init__(self, path):
+        self.conn = sqlite3.connect(path, check_same_thread=False)
+
+    def cursor(self, *_):
+        ''' Return a cursor (the cursor class is ignored) '''
+        return SageCursor(self.conn)
+
+    def close(self):
+        ''' Close the connection '''
+        self.conn.close()
+
+
+class StubHandler(BaseHTTPRequestHandler):
+    ''' Handler for the config and jacsv2 stub server '''
+    server_version = 'BenchmarkStub/' + __version__
+
+    def reply(self, data, status=200):
+        ''' Send a JSON response '''
+        body = json.dumps(data).encode()
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def read_body(self):
+        ''' Read (and discard) the request body '''
+        self.rfile.read(int(self.headers.get('Content-Length', 0)))
+
+    def do_GET(self): # pylint: disable=invalid-name
+        ''' Serve configuration documents '''
+        name = self.path.strip('/').split('/')[-1]
+        if self.path.startswith('/config/') and name in self.server.configs:
+            self.reply({'config': self.server.configs[name]})
+        else:
+            self.reply({'rest': {'message': 'Not found'}}, 404)
+
+    def do_PUT(self): # pylint: disable=invalid-name
+        ''' Accept JACS updates '''
+        self.read_body()
+        if re.match(r'/jacsv2/colorDepthMIPs/[^/]+/publicURLs$', self.path):
+            if self.server.jacs_latency:
+                sleep(self.server.jacs_latency)
+            with self.server.lock:
+                self.server.jacs_updates += 1
+            self.reply({})
+        else:
+            self.reply({'rest': {'message': 'Not found'}}, 404)
+
+    def do_POST(self): # pylint: disable=invalid-name
+        ''' Accept configuration updates '''
+        self.read_body()
+        self.reply({'rest': {'message': 'OK'}})
+
+    def log_message(self, *_): # pylint: disable=arguments-differ
+        return
+
+
+def start_stub_server(workdir):
+    ''' Start the config and jacsv2 stub server in a daemon thread
+        Keyword arguments:
+          workdir: work directory
+        Returns:
+          server
+    '''
+    server = ThreadingHTTPServer(('127.0.0.1', 0), StubHandler)
+    server.daemon_threads = True
+    base = 'http://127.0.0.1:%d/' % (server.server_address[1])
+    server.base_url = base
+    server.lock = threading.Lock()
+    server.jacs_updates = 0
+    server.jacs_latency = ARG.JACS_LATENCY / 1000
+    server.configs = {
+        'rest_services': {'config': {'url': base}, 'jacsv2': {'url': base + 'jacsv2/'}},
+        'upload_cdms': {'temp_dir': os.path.join(workdir, 'converted') + '/',
+                        'json_dir': workdir,
+                        'drivers': ['GAL4', 'LexA', 'Split_GAL4'],
+                        'version_required': []},
+        'aws': {'base_aws_url': 'https://s3.amazonaws.com',
+                's3_bucket': {'cdm': 'benchmark-cdm', 'cdm-thumbnail': 'benchmark-cdm-thumbnail'}},
+        'cdm_library': {LIBRARY['flylight']: {'name': 'FlyLight Benchmark'},
+                        LIBRARY['flyem']: {'name': 'FlyEM Benchmark'}},
+        'db_config': {'sage': {'prod': {'name': 'sage', 'host': 'sqlite', 'user': 'bench',
+                                        'password': ''}}}}
+    threading.Thread(target=server.serve_forever, name='stub', daemon=True).start()
+    return server
+
+
+def make_fixture(path, seed):
+    ''' Write a synthetic color depth MIP (black background with colored strokes)
+        Keyword arguments:
+          path: file path (the extension determines the format)
+          seed: random seed
+        Returns:
+          None
+    '''
+    rnd = random.Random(seed)
+    image = Image.new('RGB', (ARG.WIDTH, ARG.HEIGHT))
+    draw = ImageDraw.Draw(image)
+    for _ in range(40):
+        points = [(rnd.randrange(ARG.WIDTH), rnd.randrange(ARG.HEIGHT)) for _ in range(6)]
+        color = (rnd.randrange(256), rnd.randrange(256), rnd.randrange(256))
+        draw.line(points, fill=color, width=rnd.randrange(1, 6))
+    image.save(path)
+
+
+def generate_fixtures(workdir, samples):
+    ''' Generate image fixtures, NeuronBridge JSON files and the SAGE stand-in
+        Keyword arguments:
+          workdir: work directory
+          samples: number of samples per JSON file
+        Returns:
+          None
+    '''
+    fixdir = os.path.join(workdir, 'fixtures')
+    os.makedirs(fixdir, exist_ok=True)
+    os.makedirs(os.path.join(workdir, 'converted'), exist_ok=True)
+    LOGGER.info("Generating %d fixtures (%dx%d)", ARG.FIXTURES, ARG.WIDTH, ARG.HEIGHT)
+    for num in range(ARG.FIXTURES):
+        make_fixture(os.path.join(fixdir, 'bench_%02d-CH1_CDM.png' % (num)), num)
+        make_fixture(os.path.join(fixdir, 'bench_%02d-CH1_CDM.tif' % (num)), num)
+        for variant in VARIANTS:
+            make_fixture(os.path.join(fixdir, '%s_%02d-CH1-01.tif' % (variant, num)),
+                         num * 10 + len(variant))
+    light = list()
+    flyem = list()
+    rows = list()
+    for num in range(samples):
+        fix = num % ARG.FIXTURES
+        variants = {variant: os.path.join(fixdir, '%s_%02d-CH1-01.tif' % (variant, fix))
+                    for variant in VARIANTS}
+        line = 'BENCH_%05d' % (num // 4)
+        light.append({'id': str(100000 + num), 'name': 'bench_%d' % (num),
+                      'imageName': 'bench_%06d.png' % (num),
+                      'cdmPath': os.path.join(fixdir, 'bench_%02d-CH1_CDM.png' % (fix)),
+                      'sampleRef': 'Sample#%d' % (2000000 + num), 'publishedName': line,
+                      'slideCode': '20200101_%06d_A1' % (num), 'gender': 'f',
+                      'objective': '20x', 'anatomicalArea': 'Brain',
+                      'alignmentSpace': ALIGNMENT_SPACE, 'variants': variants})
+        flyem.append({'id': str(300000 + num), 'name': 'body_%d' % (num),
+                      'imageName': 'body_%06d.tif' % (num),
+                      'cdmPath': os.path.join(fixdir, 'bench_%02d-CH1_CDM.tif' % (fix)),
+                      'publishedName': str(10000 + num),
+                      'alignmentSpace': ALIGNMENT_SPACE, 'variants': dict(variants)})
+        rows.append((line, DRIVERS[(num // 4) % 2], str(2000000 + num), 'Y', 'BENCH', line, line,
+                     'Gen1'))
+    # Lines that aren't in the JSON (the full mapping queries have to read these too)
+    for num in range(ARG.SAGE_ROWS):
+        line = 'OTHER_%06d' % (num // 4)
+        rows.append((line, DRIVERS[(num // 4) % len(DRIVERS)], str(5000000 + num), 'Y', 'OTHER',
+                     line, line, 'Gen1'))
+    for jtype, data in (('flylight', light), ('flyem', flyem)):
+        with open(os.path.join(workdir, jtype + '.json'), 'w') as jfile:
+            json.dump(data, jfile)
+    path = os.path.join(workdir, 'sage.db')
+    if os.path.exists(path):
+        os.remove(path)
+    conn = sqlite3.connect(path)
+    conn.execute("CREATE TABLE image_data_mv (publishing_name TEXT, driver TEXT, "
+                 + "workstation_sample_id TEXT, to_publish TEXT, alps_release TEXT, "
+                 + "line TEXT, original_line TEXT, published_to TEXT)")
+    conn.executemany("INSERT INTO image_data_mv VALUES (?,?,?,?,?,?,?,?)", rows)
+    conn.execute("CREATE TABLE line_property_vw (name TEXT, type TEXT, value TEXT)")
+    conn.executemany("INSERT INTO line_property_vw VALUES (?,'flycore_project',?)",
+                     {(row[0], row[1]) for row in rows})
+    conn.commit()
+    conn.close()
+
+
+def install_stand_ins(workdir, s3_emulator):
+    ''' Route upload_cdms' S3, SAGE and interactive calls to the local stand-ins
+        Keyword arguments:
+          workdir: work directory
+          s3_emulator: LocalS3 instance
+        Returns:
+          None
+    '''
+    sage = os.path.join(workdir, 'sage.db')
+    boto3.client = lambda *_, **__: s3_emulator
+    boto3.resource = lambda *_, **__: None
+    MySQLdb.connect = lambda **_: SageConnection(sage)
+    inquirer.prompt = lambda _: {'checklist': list(VARIANTS)}
+
+
+def run_scenario(name):
+    ''' Run one scenario (in this process) and write its results to
+        <workdir>/<name>/result.json
+        Keyword arguments:
+          name: scenario name
+        Returns:
+          None
+    '''
+    scenario = SCENARIOS[name]
+    rundir = os.path.join(ARG.WORKDIR, name)
+    os.makedirs(rundir, exist_ok=True)
+    os.chdir(rundir)
+    s3_emulator = LocalS3(ARG.S3_LATENCY / 1000)
+    install_stand_ins(ARG.WORKDIR, s3_emulator)
+    token = jwt.encode({'exp': int(time()) + 3600, 'full_name': 'Benchmark'}, 'benchmark')
+    os.environ['JACS_JWT'] = token.decode() if isinstance(token, bytes) else token
+    os.environ['CONFIG_SERVER_URL'] = ARG.CONFIG_URL
+    samples = ARG.SAMPLES if ARG.SAMPLES else scenario['samples']
+    sys.argv = [UPLOAD_CDMS, '--library', LIBRARY[scenario['type']],
+                '--neuronbridge', 'benchmark',
+                '--json', os.path.join(ARG.WORKDIR, scenario['type'] + '.json'),
+                '--samples', str(samples), '--manifold', 'dev', '--aws', '--write',
+                '--metrics', os.path.join(rundir, 'metrics'), '--metrics-interval', '0'] \
+        + scenario['args']
+    start = time()
+    code = 0
+    try:
+        runpy.run_path(UPLOAD_CDMS, run_name='__main__')
+    except SystemExit as err:
+        code = err.code
+    elapsed = time() - start
+    result = {'scenario': name, 'exit_code': code, 'samples': samples,
+              'elapsed': round(elapsed, 3),
+              'objects': s3_emulator.uploaded['objects'],
+              'bytes': s3_emulator.uploaded['bytes'],
+              'samples_per_second': round(samples / elapsed, 2),
+              'bytes_per_second': round(s3_emulator.uploaded['bytes'] / elapsed, 1),
+              # ru_maxrss is in KB on Linux
+              'peak_rss_mb': round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+                                   / 1024, 1),
+              'children_peak_rss_mb': round(resource.getrusage(resource.RUSAGE_CHILDREN)
+                                            .ru_maxrss / 1024, 1)}
+    with open(os.path.join(rundir, 'result.json'), 'w') as rfile:
+        json.dump(result, rfile)
+
+
+def run_benchmarks():
+    ''' Generate fixtures, then run each selected scenario in its own process
+        Keyword arguments:
+          None
+        Returns:
+          list of results
+    '''
+    scenarios = ARG.SCENARIO if ARG.SCENARIO else list(SCENARIOS)
+    samples = ARG.SAMPLES if ARG.SAMPLES else max(SCENARIOS[name]['samples']
+                                                  for name in scenarios)
+    generate_fixtures(ARG.WORKDIR, samples)
+    server = start_stub_server(ARG.WORKDIR)
+    results = list()
+    for name in scenarios:
+        print("Running %s" % (name))
+        shutil.rmtree(os.path.join(ARG.WORKDIR, name), ignore_errors=True)
+        os.makedirs(os.path.join(ARG.WORKDIR, name))
+        jacs_before = server.jacs_updates
+        cmd = [sys.executable, os.path.abspath(__file__), '--run-scenario', name,
+               '--workdir', ARG.WORKDIR, '--config-url', server.base_url,
+               '--s3-latency', str(ARG.S3_LATENCY)]
+        if ARG.SAMPLES:
+            cmd.extend(['--samples', str(ARG.SAMPLES)])
+        with open(os.path.join(ARG.WORKDIR, name, 'output.txt'), 'w') as ofile:
+            subprocess.run(cmd, stdout=ofile, stderr=subprocess.STDOUT, check=False,
+                           env=dict(os.environ,
+                                    CACHE_DIR=os.path.join(ARG.WORKDIR, name, 'cache')))
+        try:
+            with open(os.path.join(ARG.WORKDIR, name, 'result.json'), 'r') as rfile:
+                result = json.load(rfile)
+        except (OSError, ValueError):
+            LOGGER.error("Scenario %s did not complete (see %s)", name,
+                         os.path.join(ARG.WORKDIR, name, 'output.txt'))
+            continue
+        result['jacs_updates'] = server.jacs_updates - jacs_before
+        if result['exit_code']:
+            LOGGER.error("upload_cdms exited with %s for %s (see %s)", result['exit_code'],
+                         name, os.path.join(ARG.WORKDIR, name, 'output.txt'))
+        results.append(result)
+    server.shutdown()
+    return results
+
+
+def compare_baseline(results):
+    ''' Compare results with a baseline file
+        Keyword arguments:
+          results: list of results
+        Returns:
+          True if no scenario regressed by more than ARG.TOLERANCE percent
+    '''
+    with open(ARG.BASELINE, 'r') as bfile:
+        baseline = {result['scenario']: result for result in json.load(bfile)['results']}
+    passed = True
+    for result in results:
+        if result['scenario'] not in baseline:
+            continue
+        base = baseline[result['scenario']]['samples_per_second']
+        change = 100 * (result['samples_per_second'] - base) / base
+        status = 'ok'
+        if change < -ARG.TOLERANCE:
+            status = 'REGRESSION'
+            passed = False
+        print("%-16s %9.2f -> %9.2f samples/s (%+.1f%%) %s"
+              % (result['scenario'], base, result['samples_per_second'], change, status))
+    return passed
+
+
+def report(results):
+    ''' Print a results table
+        Keyword arguments:
+          results: list of results
+        Returns:
+          None
+    '''
+    print("%-16s %7s %8s %9s %10s %9s %9s %10s %5s"
+          % ('Scenario', 'Samples', 'Objects', 'Time (s)', 'Samples/s', 'MB/s', 'RSS (MB)',
+             'Child RSS', 'Exit'))
+    for result in results:
+        print("%-16s %7d %8d %9.2f %10.2f %9.2f %9.1f %10.1f %5s"
+              % (result['scenario'], result['samples'], result['objects'], result['elapsed'],
+                 result['samples_per_second'], result['bytes_per_second'] / 1e6,
+                 result['peak_rss_mb'], result['children_peak_rss_mb'], result['exit_code']))
+
+
+if __name__ == '__main__':
+    PARSER = argparse.ArgumentParser(
+        description="Benchmark upload_cdms.py against local stand-ins")
+    PARSER.add_argument('--scenario', dest='SCENARIO', action='append',
+                        choices=list(SCENARIOS), help='Scenario to run (default: all)')
+    PARSER.add_argument('--samples', dest='SAMPLES', action='store', type=int,
+                        default=0, help='Samples per scenario (default: per scenario)')
+    PARSER.add_argument('--width', dest='WIDTH', action='store', type=int,
+                        default=1210, help='Fixture image width')
+    PARSER.add_argument('--height', dest='HEIGHT', action='store', type=int,
+                        default=566, help='Fixture image height')
+    PARSER.add_argument('--fixtures', dest='FIXTURES', action='store', type=int,
+                        default=8, help='Number of distinct fixture images')
+    PARSER.add_argument('--sage-rows', dest='SAGE_ROWS', action='store', type=int,
+                        default=50000, help='Additional SAGE rows for lines not in the JSON')
+    PARSER.add_argument('--s3-latency', dest='S3_LATENCY', action='store', type=float,
+                        default=0, help='Simulated latency per S3 upload (ms)')
+    PARSER.add_argument('--jacs-latency', dest='JACS_LATENCY', action='store', type=float,
+                        default=0, help='Simulated latency per JACS update (ms)')
+    PARSER.add_argument('--workdir', dest='WORKDIR', action='store',
+                        default='', help='Work directory (default: a new temp directory)')
+    PARSER.add_argument('--output', dest='OUTPUT', action='store',
+                        default='', help='Write results to this JSON file')
+    PARSER.add_argument('--baseline', dest='BASELINE', action='store',
+                        default='', help='Compare with results from a previous --output')
+    PARSER.add_argument('--tolerance', dest='TOLERANCE', action='store', type=float,
+                        default=10, help='Allowed samples/sec regression (percent)')
+    PARSER.add_argument('--run-scenario', dest='RUN_SCENARIO', action='store',
+                        choices=list(SCENARIOS), help=argparse.SUPPRESS)
+    PARSER.add_argument('--config-url', dest='CONFIG_URL', action='store',
+                        default='', help=argparse.SUPPRESS)
+    PARSER.add_argument('--verbose', dest='VERBOSE', action='store_true',
+                        default=False, help='Flag, Chatty')
+    PARSER.add_argument('--debug', dest='DEBUG', action='store_true',
+                        default=False, help='Flag, Very chatty')
+    ARG = PARSER.parse_args()
+    if ARG.RUN_SCENARIO:
+        # upload_cdms sets up its own logging
+        run_scenario(ARG.RUN_SCENARIO)
+        sys.exit(0)
+    LOGGER = colorlog.getLogger()
+    if ARG.DEBUG:
+        LOGGER.setLevel(colorlog.colorlog.logging.DEBUG)
+    elif ARG.VERBOSE:
+        LOGGER.setLevel(colorlog.colorlog.logging.INFO)
+    else:
+        LOGGER.setLevel(colorlog.colorlog.logging.WARNING)
+    HANDLER = colorlog.StreamHandler()
+    HANDLER.setFormatter(colorlog.ColoredFormatter())
+    LOGGER.addHandler(HANDLER)
+    ARG.WORKDIR = os.path.abspath(ARG.WORKDIR) if ARG.WORKDIR \
+        else tempfile.mkdtemp(prefix='upload_cdms_benchmark_')
+    print("Work directory: %s" % (ARG.WORKDIR))
+    RESULTS = run_benchmarks()
+    report(RESULTS)
+    if ARG.OUTPUT:
+        with open(ARG.OUTPUT, 'w') as OFILE:
+            json.dump({'version': __version__, 'width': ARG.WIDTH, 'height': ARG.HEIGHT,
+                       'results': RESULTS}, OFILE, indent=2)
+    if ARG.BASELINE and not compare_baseline(RESULTS):
+        sys.exit(1)
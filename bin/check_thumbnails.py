@@ -4,16 +4,16 @@ __version__ = '1.0.0'
 
 import argparse
 import os
-import socket
 import sys
 from time import strftime, time
 import boto3
 from botocore.exceptions import ClientError
 import colorlog
 import jwt
-import requests
 import MySQLdb
 from PIL import Image
+import mapping_lib as ML
+import responder_lib as RL
 
 
 # Configuration
@@ -23,6 +23,7 @@ LIBRARY = dict()
 DATABASE = 'sage'
 CONN = dict()
 CURSOR = dict()
+DB_CONFIG = dict()
 
 GEN1_COLLECTION = ['flylight_gen1_gal4', 'flylight_gen1_lexa', 'flylight_vt_gal4_screen',
                    'flylight_vt_lexa_screen', 'flylight_gen1_mcfo_case_1']
@@ -37,6 +38,8 @@ REC = {'line': '', 'slide_code': '', 'gender': '', 'objective': '', 'area': ''}
 S3_CLIENT = S3_RESOURCE = ''
 MAX_SIZE = 500
 CREATE_THUMBNAIL = True
+# Thumbnails already written while converting their source image
+RENDERED = set()
 
 
 def call_responder(server, endpoint, payload='', authenticate=False):
@@ -49,27 +52,11 @@ def call_responder(server, endpoint, payload='', authenticate=False):
         Returns:
           JSON response
     '''
-    url = (CONFIG[server]['url'] if server else '') + endpoint
     try:
-        if payload or authenticate:
-            headers = {"Content-Type": "application/json",
-                       "Authorization": "Bearer " + os.environ['JACS_JWT']}
-        if payload:
-            headers['Accept'] = 'application/json'
-            headers['host'] = socket.gethostname()
-            req = requests.put(url, headers=headers, json=payload)
-        else:
-            if authenticate:
-                req = requests.get(url, headers=headers)
-            else:
-                req = requests.get(url)
-    except requests.exceptions.RequestException as err:
+        return RL.call_responder(CONFIG, server, endpoint, payload, authenticate)
+    except RL.ResponderError as err:
         LOGGER.critical(err)
         sys.exit(-1)
-    if req.status_code == 200:
-        return req.json()
-    print("Could not get response from %s: %s" % (url, req.text))
-    sys.exit(-1)
 
 
 def sql_error(err):
@@ -129,9 +116,9 @@ def initialize_program():
     manifold = 'prod'
     if ARG.LIBRARY == 'flylight_splitgal4_drivers':
         manifold = 'staging'
-    (CONN[DATABASE], CURSOR[DATABASE]) = db_connect(data['config'][DATABASE][manifold])
+    DB_CONFIG[DATABASE] = data['config'][DATABASE][manifold]
     if DATABASE != 'sage':
-        (CONN['sage'], CURSOR['sage']) = db_connect(data['config']['sage']['prod'])
+        DB_CONFIG['sage'] = data['config']['sage']['prod']
     data = call_responder('config', 'config/cdm_libraries')
     LIBRARY = data['config']
     if ARG.LIBRARY not in LIBRARY:
@@ -225,6 +212,39 @@ def get_r_line(line0):
     return r_line
 
 
+def get_cursor(dbname):
+    ''' Return a server-side (streaming) cursor for a database, connecting on first use
+        Keyword arguments:
+          dbname: database name
+        Returns:
+          database cursor
+    '''
+    if dbname not in CONN:
+        (CONN[dbname], CURSOR[dbname]) = db_connect(DB_CONFIG[dbname])
+    return CONN[dbname].cursor(MySQLdb.cursors.SSCursor)
+
+
+def cached_mapping(dbname, name, stmt, tables):
+    ''' Yield rows for a mapping query from the local mapping cache
+        Keyword arguments:
+          dbname: database name
+          name: cached query name
+          stmt: SQL statement
+          tables: list of source tables
+        Returns:
+          row tuples (generator)
+    '''
+    name = '_'.join([dbname, DB_CONFIG[dbname]['host'], DB_CONFIG[dbname]['name'], name])
+    try:
+        yield from ML.cached_query(name, stmt, tables, lambda: get_cursor(dbname),
+                               ARG.REFRESH_MAPPINGS)
+    except MySQLdb.Error as err:
+        sql_error(err)
+    except ML.MappingCacheError as err:
+        LOGGER.critical(err)
+        sys.exit(-1)
+
+
 def publishing_name_mapping():
     ''' Create a mapping of lines to publishing names
         Keyword arguments:
@@ -248,25 +268,20 @@ def publishing_name_mapping():
                    + "WHERE published_to IS NOT NULL"
             lkey = 'line'
             mapcol = 'publishing_name'
-        try:
-            CURSOR[DATABASE].execute(stmt)
-            rows = CURSOR[DATABASE].fetchall()
-        except MySQLdb.Error as err:
-            sql_error(err)
-        for row in rows:
-            if not row[lkey]:
-                #row[lkey] = row[mapcol]
-                print(row)
-                LOGGER.error("Missing original line for %s", row[mapcol])
+        rows = cached_mapping(DATABASE, 'published_lines_' + lkey, stmt, ['image_data_mv'])
+        for (published_to, lval, mval) in rows:
+            if not lval:
+                print({'published_to': published_to, lkey: lval, mapcol: mval})
+                LOGGER.error("Missing original line for %s", mval)
                 sys.exit(-1)
-            if 'FLEW' in row['published_to']:
-                row[lkey] = degenerate_line(row[lkey])
-                if not row[mapcol]:
-                    row[mapcol] = get_r_line(row[lkey])
-                row[mapcol] = row[mapcol].replace('L', '')
-            mapping[row[lkey]] = row[mapcol]
-            if not row[mapcol]:
-                LOGGER.error("Missing publishing name for %s", row[lkey])
+            if 'FLEW' in published_to:
+                lval = degenerate_line(lval)
+                if not mval:
+                    mval = get_r_line(lval)
+                mval = mval.replace('L', '')
+            mapping[lval] = mval
+            if not mval:
+                LOGGER.error("Missing publishing name for %s", lval)
     return mapping
 
 
@@ -286,25 +301,21 @@ def get_line_mapping():
 
     # Populate driver dict
     LOGGER.info("Getting line/driver mapping")
-    try:
-        CURSOR['sage'].execute("SELECT name,value FROM line_property_vw WHERE " \
-                               + "type='flycore_project'")
-        rows = CURSOR['sage'].fetchall()
-    except MySQLdb.Error as err:
-        sql_error(err)
-    for row in rows:
-        driver[row['name']] = row['value'].replace("_Collection", "").replace("-", "_")
+    rows = cached_mapping('sage', 'line_project',
+                          "SELECT name,value FROM line_property_vw WHERE " \
+                          + "type='flycore_project'",
+                          ['line_property', 'line', 'cv_term'])
+    for (name, value) in rows:
+        driver[name] = sys.intern(value.replace("_Collection", "").replace("-", "_"))
     # Populate release dict
     if ARG.LIBRARY == 'flylight_splitgal4_drivers':
         LOGGER.info("Getting line/release mapping")
-        try:
-            CURSOR['sage'].execute("SELECT line,GROUP_CONCAT(DISTINCT alps_release) AS alps " \
-                                   + "FROM image_data_mv WHERE alps_release IS NOT NULL GROUP BY 1")
-            rows = CURSOR['sage'].fetchall()
-        except MySQLdb.Error as err:
-            sql_error(err)
-        for row in rows:
-            release[row['line']] = row['alps']
+        rows = cached_mapping('sage', 'line_release',
+                              "SELECT line,GROUP_CONCAT(DISTINCT alps_release) AS alps " \
+                              + "FROM image_data_mv WHERE alps_release IS NOT NULL GROUP BY 1",
+                              ['image_data_mv'])
+        for (line, alps) in rows:
+            release[line] = alps
     return mapping, driver, release
 
 
@@ -352,11 +363,36 @@ def convert_file(sourcepath, newname):
           New filepath
     '''
     newpath = '/tmp/' + newname
-    with Image.open(sourcepath) as image:
-        image.save(newpath, 'PNG')
+    outputs = [(newpath, 'PNG', 0)]
+    if CREATE_THUMBNAIL:
+        # Write the thumbnail from the same decoded image
+        thumbpath = '/tmp/' + newname.replace('.png', '.jpg')
+        outputs.append((thumbpath, 'JPEG', MAX_SIZE))
+        RENDERED.add(thumbpath)
+    render_outputs(sourcepath, outputs)
     return newpath
 
 
+def render_outputs(sourcepath, outputs):
+    ''' Decode an image once and write each requested file from it
+        Keyword arguments:
+          sourcepath: source filepath
+          outputs: list of (filepath, format, maximum size). A maximum size of 0
+                   keeps the full size.
+        Returns:
+          None
+    '''
+    with Image.open(sourcepath) as image:
+        image.load()
+        for target, fmt, max_size in outputs:
+            if max_size:
+                derived = image.copy()
+                derived.thumbnail(calculate_size(image.size, max_size))
+                derived.save(target, fmt)
+            else:
+                image.save(target, fmt)
+
+
 def process_hemibrain(smp):
     ''' Return the file name for a hemibrain sample.
         Keyword arguments:
@@ -488,22 +524,23 @@ def process_light(smp, mapping, driver, release):
     return newname
 
 
-def calculate_size(dim):
-    ''' Return the fnew dimensions for an image. The longest side will be scaled down to MAX_SIZE.
+def calculate_size(dim, max_size=MAX_SIZE):
+    ''' Return the fnew dimensions for an image. The longest side will be scaled down to max_size.
         Keyword arguments:
           dim: tuple with (X,Y) dimensions
+          max_size: maximum size of the longest side
         Returns:
           Tuple with new (X,Y) dimensions
     '''
     xdim, ydim = list(dim)
-    if xdim <= MAX_SIZE and ydim <= MAX_SIZE:
+    if xdim <= max_size and ydim <= max_size:
         return dim
     if xdim > ydim:
-        ratio = xdim / MAX_SIZE
-        xdim, ydim = [MAX_SIZE, int(ydim/ratio)]
+        ratio = xdim / max_size
+        xdim, ydim = [max_size, int(ydim/ratio)]
     else:
-        ratio = ydim / MAX_SIZE
-        xdim, ydim = [int(xdim/ratio), MAX_SIZE]
+        ratio = ydim / max_size
+        xdim, ydim = [int(xdim/ratio), max_size]
     return tuple((xdim, ydim))
 
 
@@ -515,10 +552,10 @@ def resize_image(image_path, resized_path):
         Returns:
           None
     '''
-    with Image.open(image_path) as image:
-        new_size = calculate_size(image.size)
-        image.thumbnail(new_size)
-        image.save(resized_path, 'JPEG')
+    if resized_path in RENDERED:
+        RENDERED.discard(resized_path)
+        return
+    render_outputs(image_path, [(resized_path, 'JPEG', MAX_SIZE)])
 
 
 def produce_thumbnail(dirpath, fname, newname, url):
@@ -555,8 +592,12 @@ def check_thumbnails():
             break
         COUNT['Samples'] += 1
         thumb = smp['publicThumbnailUrl']
-        request = requests.get(thumb)
-        if request.status_code == 200: 
+        try:
+            request = RL.request('HEAD', thumb)
+        except RL.ResponderError as err:
+            LOGGER.critical(err)
+            sys.exit(-1)
+        if request.status_code == 200:
             COUNT['Already present'] += 1
             continue
         REC['alignment_space'] = smp['alignmentSpace']
@@ -593,6 +634,12 @@ if __name__ == '__main__':
                         default=0, help='Number of samples to transfer')
     PARSER.add_argument('--version', dest='VERSION', action='store',
                         default='1.0', help='EM Version')
+    PARSER.add_argument('--refresh-config', dest='REFRESH_CONFIG', action='store_true',
+                        default=False, help='Flag, Bypass the local configuration cache')
+    PARSER.add_argument('--refresh-mappings', dest='REFRESH_MAPPINGS', action='store_true',
+                        default=False,
+                        help='Flag, Query the database for line mappings instead of ' \
+                             + 'using the local mapping cache')
     PARSER.add_argument('--verbose', dest='VERBOSE', action='store_true',
                         default=False, help='Flag, Chatty')
     PARSER.add_argument('--debug', dest='DEBUG', action='store_true',
@@ -612,6 +659,7 @@ if __name__ == '__main__':
 
     if ARG.LIBRARY == 'flylight_splitgal4_drivers':
         DATABASE = 'mbew'
+    RL.configure(cache_refresh=ARG.REFRESH_CONFIG)
     initialize_program()
     check_thumbnails()
     sys.exit(0)
@@ -6,21 +6,33 @@
     Two files are created in each Template/Library/<variant> prefix:
       keys_denormalized.json: list of image files in Template/Library/<variant>
       counts_denormalized.json: count of image files in Template/Library/<variant>
-    For variants in DISTRIBUTE_FILES, an order file for use with s3cp will be created
-    which will copy keys_denormalized.json to Template/Library/<variant>/KEYS/<num>
-    where <num> is a number from 0-99.
+    For variants in DISTRIBUTE_FILES, an order file for use with s3_order.py
+    will be created which will copy keys_denormalized.json to
+    Template/Library/<variant>/KEYS/<num> where <num> is a number from 0-99.
+    With --shards, the keys are instead split into disjoint shards under
+    Template/Library/<variant>/SHARDS/<num>, with an index (see publish_shards).
+    With --manifest compact or ndjson, a gzipped keys_manifest file (see
+    build_manifest) is written and distributed alongside keys_denormalized.json,
+    and its name and version are added to the DynamoDB item.
+    With --keys (key files written by upload_cdms) and/or --delete, the existing
+    searchable_neurons key files are updated instead of listing the bucket. The
+    default and other variant key files (and their counts) are left as they were,
+    so new objects of those types need a full denormalization.
 '''
 
 import argparse
+from concurrent.futures import ThreadPoolExecutor
+import gzip
 import json
 import random
 import sys
 import tempfile
 import colorlog
 import boto3
+from botocore.config import Config
 from botocore.exceptions import ClientError
-import requests
 import neuronbridge_lib as NB
+import responder_lib as RL
 
 __version__ = '1.1.1'
 # Configuration
@@ -28,7 +40,19 @@ CONFIG = {'config': {'url': 'http://config.int.janelia.org/'}}
 AWS = CDM = dict()
 KEYFILE = "keys_denormalized.json"
 COUNTFILE = "counts_denormalized.json"
+# Compact key manifests (see build_manifest)
+MANIFEST_BASE = 'keys_manifest'
+MANIFEST = {'compact': 'keys_manifest.json.gz', 'ndjson': 'keys_manifest.ndjson.gz'}
+MANIFEST_TYPE = {'compact': 'application/json', 'ndjson': 'application/x-ndjson'}
+MANIFEST_VERSION = 2
 DISTRIBUTE_FILES = ['searchable_neurons']
+# Partitioned key files (see publish_shards)
+SHARD_DIR = 'SHARDS'
+SHARD_INDEX = 'index.json'
+SHARD_VERSION = 1
+# Prefix levels discovered with a delimiter before listing (e.g. searchable_neurons/<n>/)
+LIST_DEPTH = 2
+PREFIX_TEMPLATE = 'https://%s.s3.amazonaws.com/%s'
 TAGS = 'PROJECT=CDCS&STAGE=prod&DEVELOPER=svirskasr&VERSION=%s' % (__version__)
 
 
@@ -38,16 +62,11 @@ def call_responder(server, endpoint):
         server: server
         endpoint: REST endpoint
     """
-    url = CONFIG[server]['url'] + endpoint
     try:
-        req = requests.get(url)
-    except requests.exceptions.RequestException as err:
+        return RL.call_responder(CONFIG, server, endpoint)
+    except RL.ResponderError as err:
         LOGGER.critical(err)
         sys.exit(-1)
-    if req.status_code != 200:
-        LOGGER.error('Status: %s (%s)', str(req.status_code), url)
-        sys.exit(-1)
-    return req.json()
 
 
 def initialize_program():
@@ -63,12 +82,14 @@ def initialize_program():
     random.seed()
 
 
-def upload_to_aws(s3r, body, object_name):
+def upload_to_aws(s3r, body, object_name, content_type='application/json', encoding=None):
     """ Upload a file to AWS S3
         Keyword arguments:
           s3r: S3 resource
           body: JSON
           object_name: object
+          content_type: content type
+          encoding: content encoding (e.g. gzip)
         Returns:
           None
     """
@@ -78,41 +99,68 @@ def upload_to_aws(s3r, body, object_name):
     LOGGER.info("Uploading %s", object_name)
     try:
         bucket = s3r.Bucket(ARG.BUCKET)
+        payload = {'ContentType': content_type, 'Tagging': TAGS}
+        if encoding:
+            payload['ContentEncoding'] = encoding
         bucket.put_object(Body=body,
                           Key=object_name,
                           #ACL='public-read',
-                          ContentType='application/json',
-                          Tagging=TAGS)
+                          **payload)
     except ClientError as err:
         LOGGER.error("Could not upload %s", object_name)
         LOGGER.error(str(err))
 
 
-def write_order_file(which, body, prefix):
-    """ Write an order file for use with s3cp
+def write_order_file(which, body, prefix, keyfile=KEYFILE):
+    """ Write an order file for use with s3_order.py (each line carries the object tags)
         Keyword arguments:
             which: first prefix (e.g. "searchable_neurons")
-            body: JSON
+            body: JSON (text, or bytes for a compressed manifest)
             prefix: partial key prefix
+            keyfile: file name to copy to
         Returns:
             order file name
     """
     fname = tempfile.mktemp()
-    source_file = "%s_%s.txt" % (fname, which)
+    source_file = "%s_%s_%s" % (fname, which, keyfile)
     LOGGER.info("Writing temporary file %s", source_file)
-    tfile = open(source_file, "w")
+    tfile = open(source_file, "wb" if isinstance(body, bytes) else "w")
     tfile.write(body)
     tfile.close()
-    order_file = source_file.replace('.txt', '.order')
+    order_file = "%s_%s_%s.order" % (fname, which, keyfile.split('.')[0])
     LOGGER.info("Writing order file %s", order_file)
     ofile = open(order_file, "w")
     for chunk in range(100):
-        ofile.write("%s\t%s\n" % (source_file, '/'.join([ARG.BUCKET, prefix, 'KEYS',
-                                                         str(chunk), 'keys_denormalized.json'])))
+        ofile.write("%s\t%s\tTagging=%s\n" % (source_file,
+                                                '/'.join([ARG.BUCKET, prefix, 'KEYS',
+                                                          str(chunk), keyfile]), TAGS))
     ofile.close()
     return order_file
 
 
+def build_manifest(keys, prefix):
+    """ Build a compact key manifest. The common prefix is stored once, and the
+        manifest is gzipped. The compact format is a single JSON object
+        ({"version", "prefix", "count", "keys"}); the ndjson format has the same
+        fields (except keys) on the first line, followed by one key per line.
+        Keyword arguments:
+          keys: list of keys
+          prefix: common prefix of the keys
+        Returns:
+          gzipped manifest
+    """
+    common = prefix + '/'
+    suffixes = [key[len(common):] for key in keys]
+    header = {'version': MANIFEST_VERSION, 'prefix': common, 'count': len(keys)}
+    if ARG.MANIFEST == 'ndjson':
+        lines = [json.dumps(header)] + [json.dumps(suffix) for suffix in suffixes]
+        body = "\n".join(lines) + "\n"
+    else:
+        header['keys'] = suffixes
+        body = json.dumps(header, separators=(',', ':'))
+    return gzip.compress(body.encode('utf-8'), mtime=0)
+
+
 def get_parms(s3_client):
     """ Query the user for the CDM library and manifold
         Keyword arguments:
@@ -146,6 +194,8 @@ def initialize_s3():
         Returns:
           S3 client and resource
     """
+    # Allow one pooled connection per listing worker
+    s3_config = Config(max_pool_connections=max(10, ARG.WORKERS))
     if ARG.MANIFOLD == 'prod':
         sts_client = boto3.client('sts')
         aro = sts_client.assume_role(RoleArn=AWS['role_arn'],
@@ -154,18 +204,99 @@ def initialize_s3():
         s3_client = boto3.client('s3',
                                  aws_access_key_id=credentials['AccessKeyId'],
                                  aws_secret_access_key=credentials['SecretAccessKey'],
-                                 aws_session_token=credentials['SessionToken'])
+                                 aws_session_token=credentials['SessionToken'],
+                                 config=s3_config)
         s3_resource = boto3.resource('s3',
                                      aws_access_key_id=credentials['AccessKeyId'],
                                      aws_secret_access_key=credentials['SecretAccessKey'],
                                      aws_session_token=credentials['SessionToken'])
     else:
         ARG.BUCKET = '-'.join([ARG.BUCKET, ARG.MANIFOLD])
-        s3_client = boto3.client('s3')
+        s3_client = boto3.client('s3', config=s3_config)
         s3_resource = boto3.resource('s3')
     return s3_client, s3_resource
 
 
+def read_subdivision_plan():
+    """ Read the batch size and count from an upload_cdms subdivision plan (to check
+        the listed batches against)
+        Keyword arguments:
+          None
+        Returns:
+          plan dictionary, or None if no plan was specified
+    """
+    if not ARG.SUBDIVISION_PLAN:
+        return None
+    try:
+        with open(ARG.SUBDIVISION_PLAN, 'r') as pfile:
+            plan = json.load(pfile)
+    except (OSError, ValueError) as err:
+        LOGGER.critical("Could not read subdivision plan %s: %s", ARG.SUBDIVISION_PLAN, err)
+        sys.exit(-1)
+    print("Checking batches against batch size %d and batch count %d from %s"
+          % (plan['batch_size'], plan['batch_count'], ARG.SUBDIVISION_PLAN))
+    return plan
+
+
+def skip_key(key):
+    """ Determine if a key is a denormalization file rather than an image
+        Keyword arguments:
+          key: object key
+        Returns:
+          True if the key should be skipped
+    """
+    return KEYFILE in key or COUNTFILE in key or MANIFEST_BASE in key or "pngs" in key \
+           or '/%s/' % (SHARD_DIR) in key
+
+
+def list_level(s3_client, prefix):
+    """ List one level of a prefix
+        Keyword arguments:
+          s3_client: S3 client
+          prefix: prefix (ending in /)
+        Returns:
+          list of sub-prefixes, list of keys directly under the prefix
+    """
+    prefixes = list()
+    keys = list()
+    paginator = s3_client.get_paginator('list_objects_v2')
+    for page in paginator.paginate(Bucket=ARG.BUCKET, Prefix=prefix, Delimiter='/'):
+        prefixes.extend([cpx['Prefix'] for cpx in page.get('CommonPrefixes', [])])
+        keys.extend([obj['Key'] for obj in page.get('Contents', [])])
+    return prefixes, keys
+
+
+def list_keys(s3_client, prefix):
+    """ List all keys under a prefix. Sub-prefixes are discovered LIST_DEPTH levels
+        down with a delimiter, then each one is listed concurrently, so the time taken
+        is roughly that of the largest sub-prefix rather than the whole tree.
+        Keyword arguments:
+          s3_client: S3 client
+          prefix: top-level prefix
+        Returns:
+          sorted list of keys
+    """
+    keys = list()
+    level = [prefix]
+    with ThreadPoolExecutor(max_workers=ARG.WORKERS) as executor:
+        for _ in range(LIST_DEPTH):
+            found = list()
+            for prefixes, level_keys in executor.map(lambda pfx: list_level(s3_client, pfx),
+                                                     level):
+                found.extend(prefixes)
+                keys.extend(level_keys)
+            level = found
+            LOGGER.info("Found %d prefixes", len(level))
+        for level_keys in executor.map(lambda pfx: [obj['Key'] for obj in
+                                                    NB.get_all_s3_objects(s3_client,
+                                                                          Bucket=ARG.BUCKET,
+                                                                          Prefix=pfx)],
+                                       level):
+            keys.extend(level_keys)
+    keys.sort()
+    return keys
+
+
 def populate_batch_dict(s3_client, prefix):
     """ Produce a dict with key/batch information
         Keyword arguments:
@@ -176,44 +307,285 @@ def populate_batch_dict(s3_client, prefix):
     """
     total_objects = dict()
     key_list = dict()
-    max_batch = dict()
-    first_batch = dict()
-    for which in DISTRIBUTE_FILES:
-        max_batch[which] = 0
-        first_batch[which] = 0
-    for obj in NB.get_all_s3_objects(s3_client, Bucket=ARG.BUCKET, Prefix=prefix):
-        if KEYFILE in obj['Key'] or COUNTFILE in obj['Key'] or "pngs" in obj['Key']:
+    for key in list_keys(s3_client, prefix):
+        if skip_key(key):
             continue
         which = 'default'
-        LOGGER.debug(obj['Key'])
-        splitkey = obj['Key'].split('/')
+        LOGGER.debug(key)
+        splitkey = key.split('/')
         if len(splitkey) >= 4:
             which = splitkey[2]
         if which not in key_list:
             key_list[which] = list()
             total_objects[which] = 0
         total_objects[which] += 1
-        key_list[which].append(obj['Key'])
-        if which in DISTRIBUTE_FILES:
-            num = int(obj['Key'].split("/")[3])
-            if not first_batch[which]:
-                first_batch[which] = num
-            if num > max_batch[which]:
-                max_batch[which] = num
-    batch_size = dict()
-    for which in DISTRIBUTE_FILES:
-        batch_size[which] = 0
-        objs = NB.get_all_s3_objects(s3_client, Bucket=ARG.BUCKET, Prefix=prefix + which + "/"
-                                     + str(first_batch[which]) + "/")
-        for obj in objs:
-            batch_size[which] += 1
+        key_list[which].append(key)
     batch_dict = {'count': total_objects,
-                  'keys': key_list,
-                  'size': batch_size,
-                  'max_batch': max_batch}
+                  'keys': key_list}
     return batch_dict
 
 
+def count_batches(keys):
+    """ Count the objects in each batch of a distributed variant
+        Keyword arguments:
+          keys: list of keys (<template>/<library>/<variant>/<batch>/<file>)
+        Returns:
+          dictionary of object count by batch number
+    """
+    batches = dict()
+    for key in keys:
+        num = int(key.split('/')[3])
+        batches[num] = batches.get(num, 0) + 1
+    return batches
+
+
+def batch_statistics(which, batches, plan):
+    """ Summarize the object counts of a variant's batches (as listed). The
+        subdivision plan, if any, is only used to check them.
+        Keyword arguments:
+          which: variant (e.g. "searchable_neurons")
+          batches: dictionary of object count by batch number
+          plan: upload_cdms subdivision plan (or None)
+        Returns:
+          dictionary of batch statistics (for the DynamoDB payload)
+    """
+    if not batches:
+        return {'batch_size': 0, 'num_batches': 0, 'batch_count': 0}
+    sizes = batches.values()
+    histogram = dict()
+    for size in sizes:
+        histogram[str(size)] = histogram.get(str(size), 0) + 1
+    stats = {'batch_size': max(sizes),
+             'num_batches': max(batches),
+             'batch_count': len(batches),
+             'first_batch': min(batches),
+             'batch_size_min': min(sizes),
+             'batch_size_max': max(sizes),
+             'batch_size_histogram': histogram}
+    # The listing is what's on S3; the plan also counts files upload_cdms skipped
+    if plan and which == 'searchable_neurons' \
+       and (stats['num_batches'] != plan['batch_count']
+            or stats['batch_size_max'] > plan['batch_size']):
+        LOGGER.warning("%s has %d batches of up to %d objects, but the subdivision plan "
+                       + "has %d batches of %d", which, stats['num_batches'],
+                       stats['batch_size_max'], plan['batch_count'], plan['batch_size'])
+    missing = stats['num_batches'] - stats['first_batch'] + 1 - stats['batch_count']
+    if missing > 0:
+        LOGGER.warning("%s is missing %d batch(es) between %d and %d", which, missing,
+                       stats['first_batch'], stats['num_batches'])
+    return stats
+
+
+def publish_shards(s3_resource, keys, prefix):
+    """ Upload a variant's (shuffled) keys as ARG.SHARDS disjoint shards of nearly
+        equal size, plus an index giving each shard's offset and count, so a search
+        worker only needs to fetch its own shard:
+          <prefix>/SHARDS/<num>/keys_denormalized.json (and keys_manifest with --manifest)
+          <prefix>/SHARDS/index.json
+        Keyword arguments:
+          s3_resource: S3 resource
+          keys: list of keys
+          prefix: variant prefix
+        Returns:
+          shard summary (for the DynamoDB payload)
+    """
+    names = [KEYFILE]
+    if ARG.MANIFEST in MANIFEST:
+        names.append(MANIFEST[ARG.MANIFEST])
+    shards = list()
+    total = len(keys)
+    for num in range(ARG.SHARDS):
+        offset = num * total // ARG.SHARDS
+        shard = keys[offset:(num + 1) * total // ARG.SHARDS]
+        shard_prefix = '/'.join([prefix, SHARD_DIR, str(num)])
+        upload_to_aws(s3_resource, json.dumps(shard), '/'.join([shard_prefix, KEYFILE]))
+        if ARG.MANIFEST in MANIFEST:
+            upload_to_aws(s3_resource, build_manifest(shard, prefix),
+                          '/'.join([shard_prefix, MANIFEST[ARG.MANIFEST]]),
+                          MANIFEST_TYPE[ARG.MANIFEST], 'gzip')
+        shards.append({'offset': offset, 'count': len(shard)})
+    index = {'version': SHARD_VERSION, 'count': total, 'prefix': '/'.join([prefix, SHARD_DIR]),
+             'names': names, 'shards': shards}
+    upload_to_aws(s3_resource, json.dumps(index), '/'.join([prefix, SHARD_DIR, SHARD_INDEX]))
+    print("%s: %d shards of %d-%d keys" % (prefix, ARG.SHARDS, total // ARG.SHARDS,
+                                           -(-total // ARG.SHARDS)))
+    return {'version': SHARD_VERSION, 'count': ARG.SHARDS,
+            'index': '/'.join([SHARD_DIR, SHARD_INDEX])}
+
+
+def publish_keys(s3_resource, payload, which, keys, plan, order_file):
+    """ Upload the key and count files for a prefix and add it to the DynamoDB payload
+        Keyword arguments:
+          s3_resource: S3 resource
+          payload: DynamoDB payload
+          which: "default" or variant (e.g. "searchable_neurons")
+          keys: list of keys
+          plan: upload_cdms subdivision plan (or None)
+          order_file: list of order files (appended to)
+        Returns:
+          None
+    """
+    prefix = '/'.join([ARG.TEMPLATE, ARG.LIBRARY])
+    if which != 'default':
+        prefix += '/' + which
+        payload['subprefixes'][which] = {'count': len(keys),
+                                         'prefix': PREFIX_TEMPLATE % (ARG.BUCKET, prefix)}
+        target = payload['subprefixes'][which]
+        if which in DISTRIBUTE_FILES:
+            target.update(batch_statistics(which, count_batches(keys), plan))
+    else:
+        payload['count'] = len(keys)
+        payload['prefix'] = PREFIX_TEMPLATE % (ARG.BUCKET, prefix)
+        target = payload
+    object_name = '/'.join([prefix, KEYFILE])
+    print("%s objects: %d" % (which, len(keys)))
+    random.shuffle(keys)
+    body = json.dumps(keys, indent=4)
+    manifest = None
+    if ARG.MANIFEST in MANIFEST:
+        manifest = build_manifest(keys, prefix)
+        target['manifest'] = {'version': MANIFEST_VERSION, 'format': ARG.MANIFEST,
+                              'name': MANIFEST[ARG.MANIFEST]}
+        print("%s manifest: %d bytes" % (which, len(manifest)))
+    if which in DISTRIBUTE_FILES:
+        if ARG.SHARDS:
+            target['shards'] = publish_shards(s3_resource, keys, prefix)
+        else:
+            order_file.append(write_order_file(which, body, prefix))
+            if manifest:
+                order_file.append(write_order_file(which, manifest, prefix,
+                                                   MANIFEST[ARG.MANIFEST]))
+    upload_to_aws(s3_resource, body, object_name)
+    if manifest:
+        upload_to_aws(s3_resource, manifest, '/'.join([prefix, MANIFEST[ARG.MANIFEST]]),
+                      MANIFEST_TYPE[ARG.MANIFEST], 'gzip')
+    object_name = '/'.join([prefix, COUNTFILE])
+    upload_to_aws(s3_resource, json.dumps({"objectCount": len(keys)}, indent=4), object_name)
+
+
+def publish_payload(table, payload, order_file):
+    """ Write the DynamoDB item and show how to process the order files
+        Keyword arguments:
+          table: DynamoDB table
+          payload: DynamoDB payload
+          order_file: list of order files
+        Returns:
+          None
+    """
+    if not ARG.TEST:
+        table.put_item(Item=payload)
+    if order_file:
+        print("Order files must be processed to upload the key file to S3:")
+        print("  python3 s3_order.py --manifold %s --order %s"
+              % (ARG.MANIFOLD, ' '.join(order_file)))
+
+
+def read_key_files(key_files):
+    """ Read keys from upload_cdms key files (JSON lists) or plain text files (one key
+        per line)
+        Keyword arguments:
+          key_files: list of file names
+        Returns:
+          list of keys
+    """
+    keys = list()
+    for key_file in key_files:
+        try:
+            with open(key_file, 'r') as kfile:
+                text = kfile.read()
+        except OSError as err:
+            LOGGER.critical("Could not read %s: %s", key_file, err)
+            sys.exit(-1)
+        try:
+            keys.extend(json.loads(text))
+        except ValueError:
+            keys.extend([line.strip() for line in text.splitlines() if line.strip()])
+    return keys
+
+
+def group_keys(keys, prefix):
+    """ Group keys by variant ("default" for keys directly under the library)
+        Keyword arguments:
+          keys: list of keys
+          prefix: top-level prefix
+        Returns:
+          dictionary of key sets by variant
+    """
+    group = dict()
+    for key in keys:
+        if not key.startswith(prefix):
+            LOGGER.critical("%s is not in %s", key, prefix)
+            sys.exit(-1)
+        if skip_key(key):
+            continue
+        splitkey = key.split('/')
+        which = splitkey[2] if len(splitkey) >= 4 else 'default'
+        group.setdefault(which, set()).add(key)
+    return group
+
+
+def get_previous_keys(s3_client, which):
+    """ Read the current key file for a prefix from S3
+        Keyword arguments:
+          s3_client: S3 client
+          which: "default" or variant (e.g. "searchable_neurons")
+        Returns:
+          list of keys
+    """
+    prefix = [ARG.TEMPLATE, ARG.LIBRARY] if which == 'default' \
+             else [ARG.TEMPLATE, ARG.LIBRARY, which]
+    object_name = '/'.join(prefix + [KEYFILE])
+    try:
+        response = s3_client.get_object(Bucket=ARG.BUCKET, Key=object_name)
+        return json.loads(response['Body'].read())
+    except ClientError as err:
+        if err.response['Error']['Code'] in ('NoSuchKey', '404'):
+            LOGGER.warning("%s does not exist, starting with no keys", object_name)
+            return list()
+        LOGGER.critical("Could not read %s: %s", object_name, err)
+        sys.exit(-1)
+
+
+def denormalize_incremental(s3_client, s3_resource, table, plan):
+    """ Update the key files, counts, and DynamoDB item from the current key files
+        and upload_cdms key files (and optional deletion files), without listing
+        the bucket. Only variants in DISTRIBUTE_FILES are supported, and only
+        those whose keys changed are rewritten.
+        Keyword arguments:
+          s3_client: S3 client
+          s3_resource: S3 resource
+          table: DynamoDB table
+          plan: upload_cdms subdivision plan (or None)
+        Returns:
+          None
+    """
+    prefix = '/'.join([ARG.TEMPLATE, ARG.LIBRARY]) + '/'
+    added = group_keys(read_key_files(ARG.KEYS), prefix) if ARG.KEYS else dict()
+    deleted = group_keys(read_key_files(ARG.DELETE), prefix) if ARG.DELETE else dict()
+    # upload_cdms only records the keys it uploads under DISTRIBUTE_FILES, so
+    # the other key files (and their counts) can't be kept current this way
+    other = sorted((set(added) | set(deleted)) - set(DISTRIBUTE_FILES))
+    if other:
+        LOGGER.critical("Incremental mode only updates %s keys (found %s keys); "
+                        + "run a full denormalization instead", ', '.join(DISTRIBUTE_FILES),
+                        ', '.join(other))
+        sys.exit(-1)
+    payload = table.get_item(Key={'keyname': ARG.LIBRARY}).get('Item')
+    if not payload:
+        LOGGER.critical("%s has not been denormalized on %s; run a full denormalization first",
+                        ARG.LIBRARY, ARG.MANIFOLD)
+        sys.exit(-1)
+    order_file = list()
+    for which in sorted(set(added) | set(deleted)):
+        previous = set(get_previous_keys(s3_client, which))
+        keys = (previous | added.get(which, set())) - deleted.get(which, set())
+        print("%s: %d added, %d deleted" % (which, len(keys - previous), len(previous - keys)))
+        if keys == previous:
+            continue
+        publish_keys(s3_resource, payload, which, list(keys), plan, order_file)
+    publish_payload(table, payload, order_file)
+
+
 def denormalize():
     """ Denormalize a bucket into a JSON file
         Keyword arguments:
@@ -222,51 +594,30 @@ def denormalize():
           None
     """
     #pylint: disable=no-member
+    if ARG.SHARDS < 0:
+        LOGGER.error("--shards must be 0 or more")
+        sys.exit(-1)
     s3_client, s3_resource = initialize_s3()
     get_parms(s3_client)
     prefix = '/'.join([ARG.TEMPLATE, ARG.LIBRARY]) + '/'
     print("Processing %s on %s manifold" % (ARG.LIBRARY, ARG.MANIFOLD))
+    plan = read_subdivision_plan()
+    dynamodb = boto3.resource('dynamodb')
+    table = dynamodb.Table('janelia-neuronbridge-denormalization-%s' % (ARG.MANIFOLD))
+    if ARG.KEYS or ARG.DELETE:
+        denormalize_incremental(s3_client, s3_resource, table, plan)
+        return
     batch_dict = populate_batch_dict(s3_client, prefix)
     if not batch_dict['count'] or not batch_dict['count']['default']:
         LOGGER.error("%s/%s was not found in the %s bucket", ARG.TEMPLATE, ARG.LIBRARY, ARG.BUCKET)
         sys.exit(-1)
     # Write files
-    prefix_template = 'https://%s.s3.amazonaws.com/%s'
     payload = {'keyname': ARG.LIBRARY, 'count': 0, 'prefix': '',
                'subprefixes': dict()}
     order_file = list()
     for which in batch_dict['keys']:
-        prefix = '/'.join([ARG.TEMPLATE, ARG.LIBRARY])
-        if which != 'default':
-            prefix += '/' + which
-            payload['subprefixes'][which] = {'count': batch_dict['count'][which],
-                                             'prefix': prefix_template % (ARG.BUCKET, prefix)}
-            if which in DISTRIBUTE_FILES:
-                payload['subprefixes'][which]['batch_size'] = batch_dict['size'][which]
-                payload['subprefixes'][which]['num_batches'] = batch_dict['max_batch'][which]
-        else:
-            payload['count'] = batch_dict['count'][which]
-            payload['prefix'] = prefix_template % (ARG.BUCKET, prefix)
-        object_name = '/'.join([prefix, KEYFILE])
-        print("%s objects: %d" % (which, batch_dict['count'][which]))
-        random.shuffle(batch_dict['keys'][which])
-        if which in DISTRIBUTE_FILES:
-            order_file.append(write_order_file(which, json.dumps(batch_dict['keys'][which],
-                                                                 indent=4), prefix))
-        upload_to_aws(s3_resource, json.dumps(batch_dict['keys'][which], indent=4), object_name)
-        object_name = '/'.join([prefix, COUNTFILE])
-        upload_to_aws(s3_resource, json.dumps({"objectCount": batch_dict['count'][which]},
-                                              indent=4), object_name)
-    if not ARG.TEST:
-        dynamodb = boto3.resource('dynamodb')
-        table = 'janelia-neuronbridge-denormalization-%s' % (ARG.MANIFOLD)
-        table = dynamodb.Table(table)
-        table.put_item(Item=payload)
-    if order_file:
-        print("Order files must be processed with s3cp to upload the key file to S3:")
-        for order in order_file:
-            print("  python3 s3cp.py --order " + order)
-        print("s3cp is available at https://github.com/JaneliaSciComp/freight")
+        publish_keys(s3_resource, payload, which, batch_dict['keys'][which], plan, order_file)
+    publish_payload(table, payload, order_file)
 
 
 if __name__ == '__main__':
@@ -279,8 +630,31 @@ if __name__ == '__main__':
                         default='', help='Library')
     PARSER.add_argument('--manifold', dest='MANIFOLD', action='store',
                         default='dev', help='S3 manifold')
+    PARSER.add_argument('--subdivision-plan', dest='SUBDIVISION_PLAN', action='store',
+                        default='',
+                        help='upload_cdms subdivision plan (to check the listed ' \
+                             + 'searchable_neurons batch size and count against)')
+    PARSER.add_argument('--keys', dest='KEYS', action='store', nargs='+',
+                        help='Key files from upload_cdms (update the existing ' \
+                             + 'searchable_neurons key files instead of listing the ' \
+                             + 'bucket; other key files and counts are not updated)')
+    PARSER.add_argument('--delete', dest='DELETE', action='store', nargs='+',
+                        help='Files of searchable_neurons keys to remove (updates the ' \
+                             + 'existing key files)')
+    PARSER.add_argument('--manifest', dest='MANIFEST', action='store',
+                        choices=['json', 'compact', 'ndjson'], default='json',
+                        help='Key manifest format (compact and ndjson also write a gzipped ' \
+                             + 'keys_manifest file with the common prefix stored once)')
+    PARSER.add_argument('--shards', dest='SHARDS', action='store', type=int,
+                        default=0,
+                        help='Number of key file shards for distributed variants (0 to ' \
+                             + 'write 100 full copies under KEYS)')
+    PARSER.add_argument('--workers', dest='WORKERS', action='store', type=int,
+                        default=16, help='Number of concurrent S3 listing workers')
     PARSER.add_argument('--test', dest='TEST', action='store_true',
                         default=False, help='Test mode (do not write to bucket)')
+    PARSER.add_argument('--refresh-config', dest='REFRESH_CONFIG', action='store_true',
+                        default=False, help='Flag, Bypass the local configuration cache')
     PARSER.add_argument('--verbose', dest='VERBOSE', action='store_true',
                         default=False, help='Flag, Chatty')
     PARSER.add_argument('--debug', dest='DEBUG', action='store_true',
@@ -296,5 +670,6 @@ if __name__ == '__main__':
     HANDLER = colorlog.StreamHandler()
     HANDLER.setFormatter(colorlog.ColoredFormatter())
     LOGGER.addHandler(HANDLER)
+    RL.configure(cache_refresh=ARG.REFRESH_CONFIG)
     initialize_program()
     denormalize()
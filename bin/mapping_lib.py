@@ -0,0 +1,185 @@
+''' mapping_lib.py
+    Local cache of database mapping queries (e.g. SAGE line/driver and image mappings)
+    shared by the bin/ scripts. Query results are kept in an SQLite database in
+    CACHE_DIR (default ~/.cache/flylight). A cached query is used without touching
+    MySQL if it was checked today. Otherwise the source tables' update times are
+    compared with the values stored when the query was cached, and the query is
+    only re-run if they changed (or can't be determined, as for views such as
+    line_property_vw).
+    A refresh always re-runs the whole query: the cached queries are SELECT
+    DISTINCT/GROUP BY results over image_data_mv (a materialized view that is
+    rebuilt wholesale, so it has no usable id or update date to fetch a delta by)
+    and line_property_vw, and removed or changed source rows can't be merged into
+    a distinct/grouped result from a delta anyway. What the cache saves is the
+    query on every run where the source tables haven't changed.
+    Rows are streamed from MySQL in FETCH_SIZE chunks (use a server-side cursor) and
+    yielded while they're written to the cache, so callers never hold the full
+    result set.
+'''
+
+from datetime import date
+import json
+import os
+import sqlite3
+from time import time
+
+__version__ = '1.0.0'
+
+CACHE_FILE = os.path.join(os.environ.get('CACHE_DIR',
+                                         os.path.join(os.path.expanduser('~'), '.cache',
+                                                      'flylight')),
+                          'mapping_cache.db')
+FETCH_SIZE = 10000
+# TABLE_ROWS isn't used: it's only an estimate for InnoDB, and changes without the data changing
+SIGNATURE_STMT = "SELECT UPDATE_TIME FROM information_schema.TABLES WHERE " \
+                 + "TABLE_SCHEMA=DATABASE() AND TABLE_NAME=%s"
+
+
+class MappingCacheError(Exception):
+    ''' Raised when the mapping cache can't be read or written '''
+
+
+def open_cache(cache_file=None):
+    ''' Open (and if necessary create) the mapping cache
+        Keyword arguments:
+          cache_file: SQLite file (defaults to CACHE_FILE)
+        Returns:
+          SQLite connection
+    '''
+    cache_file = cache_file if cache_file else CACHE_FILE
+    # The directory is shared with the responder_lib config cache (credentials)
+    os.makedirs(os.path.dirname(cache_file), mode=0o700, exist_ok=True)
+    os.chmod(os.path.dirname(cache_file), 0o700)
+    conn = sqlite3.connect(cache_file, timeout=60, isolation_level=None)
+    conn.execute("PRAGMA journal_mode=WAL")
+    conn.execute("PRAGMA synchronous=NORMAL")
+    conn.execute("CREATE TABLE IF NOT EXISTS query (name TEXT PRIMARY KEY, stmt TEXT, "
+                 + "signature TEXT, checked TEXT, fetched REAL, row_count INTEGER)")
+    return conn
+
+
+def table_name(name):
+    ''' Return the SQLite table used for a cached query's rows
+        Keyword arguments:
+          name: cached query name
+        Returns:
+          table name
+    '''
+    return '"rows_%s"' % (name.replace('"', ''))
+
+
+def get_signature(cursor, tables):
+    ''' Return a signature for the current state of a set of MySQL tables
+        Keyword arguments:
+          cursor: MySQL cursor (returning tuples)
+          tables: list of source table names
+        Returns:
+          signature string, or None if a table's update time is unknown
+    '''
+    signature = list()
+    for table in tables:
+        cursor.execute(SIGNATURE_STMT, (table,))
+        row = cursor.fetchone()
+        cursor.fetchall()
+        if not row or row[0] is None:
+            return None
+        signature.append([table] + list(row))
+    return json.dumps(signature, default=str)
+
+
+def read_rows(conn, name):
+    ''' Yield the cached rows for a query
+        Keyword arguments:
+          conn: SQLite connection
+          name: cached query name
+        Returns:
+          row tuples (generator)
+    '''
+    yield from conn.execute("SELECT * FROM %s" % (table_name(name)))
+
+
+def cached_query(name, stmt, tables, get_cursor, refresh=False, cache_file=None):
+    ''' Yield the rows for a mapping query, using the local cache where possible
+        Keyword arguments:
+          name: cached query name (unique per database and statement)
+          stmt: SQL statement
+          tables: list of MySQL tables the statement reads from
+          get_cursor: function returning a MySQL cursor that returns tuples, preferably
+                      server-side (only called if MySQL is needed)
+          refresh: True to re-run the query regardless of the cache (the query is
+                   also re-run in full whenever the source tables changed)
+          cache_file: SQLite file (defaults to CACHE_FILE)
+        Returns:
+          row tuples (generator)
+    '''
+    try:
+        conn = open_cache(cache_file)
+    except (OSError, sqlite3.Error) as err:
+        raise MappingCacheError("Could not open mapping cache: %s" % (err)) from err
+    try:
+        today = date.today().isoformat()
+        entry = conn.execute("SELECT stmt,signature,checked FROM query WHERE name=?",
+                             (name,)).fetchone()
+        if entry and entry[0] != stmt:
+            entry = None
+        if entry and not refresh and entry[2] == today:
+            yield from read_rows(conn, name)
+            return
+        cursor = get_cursor()
+        signature = get_signature(cursor, tables)
+        if entry and not refresh and signature and signature == entry[1]:
+            conn.execute("UPDATE query SET checked=? WHERE name=?", (today, name))
+            yield from read_rows(conn, name)
+            return
+        cursor.execute(stmt)
+        yield from store_rows(conn, name, stmt, signature, today, cursor)
+    except sqlite3.Error as err:
+        raise MappingCacheError("Mapping cache error for %s: %s" % (name, err)) from err
+    finally:
+        conn.close()
+
+
+def store_rows(conn, name, stmt, signature, today, cursor):
+    ''' Replace the cached rows for a query with the rows from a MySQL cursor,
+        yielding each row as it's stored. Rows are written to a staging table in
+        short per-chunk transactions, so other jobs can use the cache while MySQL is
+        streamed; the staging table replaces the cached rows (in one short
+        transaction) only if all rows are read.
+        Keyword arguments:
+          conn: SQLite connection
+          name: cached query name
+          stmt: SQL statement
+          signature: source table signature
+          today: date checked (ISO format)
+          cursor: MySQL cursor (after execute)
+        Returns:
+          row tuples (generator)
+    '''
+    width = len(cursor.description)
+    staging = table_name('%s_stage_%d' % (name, os.getpid()))
+    insert = "INSERT INTO %s VALUES (%s)" % (staging, ','.join(['?'] * width))
+    conn.execute("DROP TABLE IF EXISTS %s" % (staging))
+    conn.execute("CREATE TABLE %s (%s)"
+                 % (staging, ','.join(['c%d' % (col) for col in range(width)])))
+    try:
+        count = 0
+        while True:
+            rows = cursor.fetchmany(FETCH_SIZE)
+            if not rows:
+                break
+            conn.execute("BEGIN")
+            conn.executemany(insert, rows)
+            conn.execute("COMMIT")
+            count += len(rows)
+            yield from rows
+        conn.execute("BEGIN IMMEDIATE")
+        conn.execute("DROP TABLE IF EXISTS %s" % (table_name(name)))
+        conn.execute("ALTER TABLE %s RENAME TO %s" % (staging, table_name(name)))
+        conn.execute("INSERT OR REPLACE INTO query VALUES (?,?,?,?,?,?)",
+                     (name, stmt, signature, today, time(), count))
+        conn.execute("COMMIT")
+    except BaseException:
+        if conn.in_transaction:
+            conn.execute("ROLLBACK")
+        conn.execute("DROP TABLE IF EXISTS %s" % (staging))
+        raise
@@ -0,0 +1,283 @@
+''' metrics_lib.py
+    Per-stage timing and throughput metrics for the bin/ scripts. Each observation
+    adds a latency (and optionally a byte count) to a stage's histogram. Metrics are
+    written as JSON and in Prometheus textfile format, periodically (see start) and
+    when stop is called. The JSON file includes a timeline of objects and bytes per
+    second for each stage.
+'''
+
+import json
+import os
+import threading
+from time import time
+
+__version__ = '1.0.0'
+
+# Histogram bucket upper bounds (seconds)
+BUCKETS = [0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300]
+SETTINGS = {'namespace': 'flylight', 'path': '', 'interval': 60}
+STAGES = dict()
+TIMELINE = list()
+STATE = {'start': time(), 'thread': None, 'extra': None, 'last': None}
+STOP = threading.Event()
+LOCK = threading.Lock()
+
+
+def observe(stage, seconds, nbytes=0):
+    ''' Record one item processed by a stage
+        Keyword arguments:
+          stage: stage name
+          seconds: time taken
+          nbytes: bytes processed
+        Returns:
+          None
+    '''
+    with LOCK:
+        if stage not in STAGES:
+            STAGES[stage] = {'count': 0, 'seconds': 0.0, 'max': 0.0, 'bytes': 0,
+                             'buckets': [0] * (len(BUCKETS) + 1)}
+        metric = STAGES[stage]
+        metric['count'] += 1
+        metric['seconds'] += seconds
+        metric['max'] = max(metric['max'], seconds)
+        metric['bytes'] += nbytes
+        for idx, bound in enumerate(BUCKETS):
+            if seconds <= bound:
+                metric['buckets'][idx] += 1
+                break
+        else:
+            metric['buckets'][-1] += 1
+
+
+def export(reset=False):
+    ''' Return a copy of the raw stage metrics (e.g. to send to another process)
+        Keyword arguments:
+          reset: True to clear the metrics
+        Returns:
+          stage metrics
+    '''
+    with LOCK:
+        stages = {stage: dict(metric, buckets=list(metric['buckets']))
+                  for stage, metric in STAGES.items()}
+        if reset:
+            STAGES.clear()
+    return stages
+
+
+def merge(stages):
+    ''' Add stage metrics recorded in another process (from export)
+        Keyword arguments:
+          stages: stage metrics
+        Returns:
+          None
+    '''
+    with LOCK:
+        for stage, other in stages.items():
+            if stage not in STAGES:
+                STAGES[stage] = {'count': 0, 'seconds': 0.0, 'max': 0.0, 'bytes': 0,
+                                 'buckets': [0] * (len(BUCKETS) + 1)}
+            metric = STAGES[stage]
+            for key in ('count', 'seconds', 'bytes'):
+                metric[key] += other[key]
+            metric['max'] = max(metric['max'], other['max'])
+            metric['buckets'] = [mine + theirs for mine, theirs in zip(metric['buckets'],
+                                                                       other['buckets'])]
+
+
+def percentile(metric, fraction):
+    ''' Estimate a latency percentile from a stage's histogram
+        Keyword arguments:
+          metric: stage metric
+          fraction: percentile (0-1)
+        Returns:
+          latency (seconds), interpolated linearly within the bucket containing the
+          percentile (whose upper bound is capped at the maximum latency)
+    '''
+    target = fraction * metric['count']
+    total = 0
+    for idx, count in enumerate(metric['buckets']):
+        if total + count >= target and count:
+            lower = BUCKETS[idx - 1] if idx else 0
+            upper = min(BUCKETS[idx], metric['max']) if idx < len(BUCKETS) else metric['max']
+            lower = min(lower, upper)
+            return round(lower + (upper - lower) * (target - total) / count, 4)
+        total += count
+    return metric['max']
+
+
+def sample_timeline():
+    ''' Add the objects and bytes per second since the last sample to the timeline
+        Keyword arguments:
+          None
+        Returns:
+          None
+    '''
+    now = time()
+    with LOCK:
+        current = {stage: (STAGES[stage]['count'], STAGES[stage]['bytes']) for stage in STAGES}
+    last_time, last = STATE['last'] if STATE['last'] else (STATE['start'], dict())
+    elapsed = max(now - last_time, 1e-6)
+    rates = dict()
+    for stage, (count, nbytes) in current.items():
+        prev = last.get(stage, (0, 0))
+        rates[stage] = {'objects_per_second': round((count - prev[0]) / elapsed, 3),
+                        'bytes_per_second': round((nbytes - prev[1]) / elapsed, 1)}
+    TIMELINE.append({'elapsed': round(now - STATE['start'], 1), 'rates': rates})
+    STATE['last'] = (now, current)
+
+
+def snapshot():
+    ''' Return all metrics as a dictionary
+        Keyword arguments:
+          None
+        Returns:
+          metrics dictionary
+    '''
+    elapsed = time() - STATE['start']
+    stages = dict()
+    with LOCK:
+        for stage, metric in STAGES.items():
+            stages[stage] = {'count': metric['count'],
+                             'seconds': round(metric['seconds'], 3),
+                             'mean': round(metric['seconds'] / metric['count'], 4),
+                             'p50': percentile(metric, 0.5),
+                             'p95': percentile(metric, 0.95),
+                             'max': round(metric['max'], 4),
+                             'bytes': metric['bytes'],
+                             'objects_per_second': round(metric['count'] / elapsed, 3),
+                             'bytes_per_second': round(metric['bytes'] / elapsed, 1),
+                             'buckets': dict(zip([str(bound) for bound in BUCKETS] + ['+Inf'],
+                                                 metric['buckets']))}
+    data = {'version': __version__, 'elapsed': round(elapsed, 1), 'stages': stages,
+            'timeline': list(TIMELINE)}
+    if STATE['extra']:
+        data.update(STATE['extra']())
+    return data
+
+
+def prometheus(data):
+    ''' Format metrics in Prometheus text exposition format
+        Keyword arguments:
+          data: metrics dictionary (from snapshot)
+        Returns:
+          metrics text
+    '''
+    name = SETTINGS['namespace']
+    lines = ["# HELP %s_stage_seconds Stage latency" % (name),
+             "# TYPE %s_stage_seconds histogram" % (name)]
+    for stage, metric in data['stages'].items():
+        total = 0
+        for bound, count in metric['buckets'].items():
+            total += count
+            lines.append('%s_stage_seconds_bucket{stage="%s",le="%s"} %d'
+                         % (name, stage, bound, total))
+        lines.append('%s_stage_seconds_sum{stage="%s"} %s' % (name, stage, metric['seconds']))
+        lines.append('%s_stage_seconds_count{stage="%s"} %d' % (name, stage, metric['count']))
+    lines.extend(["# HELP %s_stage_bytes_total Bytes processed by stage" % (name),
+                  "# TYPE %s_stage_bytes_total counter" % (name)])
+    for stage, metric in data['stages'].items():
+        lines.append('%s_stage_bytes_total{stage="%s"} %d' % (name, stage, metric['bytes']))
+    if data.get('counts'):
+        lines.extend(["# HELP %s_count Run counters" % (name),
+                      "# TYPE %s_count gauge" % (name)])
+        for key, value in sorted(data['counts'].items()):
+            lines.append('%s_count{name="%s"} %d' % (name, key.replace('"', "'"), value))
+    lines.extend(["# HELP %s_elapsed_seconds Run time" % (name),
+                  "# TYPE %s_elapsed_seconds gauge" % (name),
+                  "%s_elapsed_seconds %s" % (name, data['elapsed'])])
+    return "\n".join(lines) + "\n"
+
+
+def write_file(path, text):
+    ''' Atomically write a file
+        Keyword arguments:
+          path: file path
+          text: file contents
+        Returns:
+          None
+    '''
+    tmp_path = '%s.%d' % (path, os.getpid())
+    with open(tmp_path, 'w') as mfile:
+        mfile.write(text)
+    os.replace(tmp_path, path)
+
+
+def write():
+    ''' Write the metrics files (<path>.json and <path>.prom)
+        Keyword arguments:
+          None
+        Returns:
+          None
+    '''
+    if not SETTINGS['path']:
+        return
+    sample_timeline()
+    data = snapshot()
+    write_file(SETTINGS['path'] + '.json', json.dumps(data, indent=2))
+    write_file(SETTINGS['path'] + '.prom', prometheus(data))
+
+
+def start(path, interval=60, namespace=None, extra=None):
+    ''' Start writing metrics files every interval seconds
+        Keyword arguments:
+          path: metrics file path (without extension)
+          interval: seconds between writes (0 to only write when stopped)
+          namespace: Prometheus metric prefix
+          extra: function returning a dictionary of additional metrics
+                 (e.g. {'counts': {...}})
+        Returns:
+          None
+    '''
+    SETTINGS['path'] = path
+    SETTINGS['interval'] = interval
+    if namespace:
+        SETTINGS['namespace'] = namespace
+    STATE['extra'] = extra
+    STATE['start'] = time()
+    if not interval:
+        return
+
+    def run():
+        while not STOP.wait(interval):
+            try:
+                write()
+            except Exception as err: # pylint: disable=broad-except
+                print("Could not write metrics: %s" % (err))
+
+    STATE['thread'] = threading.Thread(target=run, name='metrics', daemon=True)
+    STATE['thread'].start()
+
+
+def stop():
+    ''' Stop the periodic writer and write the final metrics files
+        Keyword arguments:
+          None
+        Returns:
+          None
+    '''
+    STOP.set()
+    if STATE['thread']:
+        STATE['thread'].join()
+        STATE['thread'] = None
+    if SETTINGS['path']:
+        write()
+        SETTINGS['path'] = ''
+
+
+def report():
+    ''' Return a printable summary of stage latencies and throughput
+        Keyword arguments:
+          None
+        Returns:
+          summary text
+    '''
+    data = snapshot()
+    lines = ["%-12s %8s %9s %9s %9s %9s %10s %10s"
+             % ('Stage', 'Count', 'Avg (ms)', 'p50 (ms)', 'p95 (ms)', 'Max (ms)', 'Objects/s',
+                'MB/s')]
+    for stage, metric in data['stages'].items():
+        lines.append("%-12s %8d %9.1f %9.1f %9.1f %9.1f %10.2f %10.2f"
+                     % (stage, metric['count'], 1000 * metric['mean'], 1000 * metric['p50'],
+                        1000 * metric['p95'], 1000 * metric['max'],
+                        metric['objects_per_second'], metric['bytes_per_second'] / 1e6))
+    return "\n".join(lines)
@@ -0,0 +1,349 @@
+''' responder_lib.py
+    Shared HTTP client for calling REST responders (configuration server, JACS, etc.).
+    Connections are pooled per server, every call has a timeout, and idempotent
+    calls (GET, HEAD, PUT, DELETE) are retried with jittered exponential backoff on
+    connection errors and transient HTTP status codes. Per-endpoint call counts and
+    latencies are kept in STATS (calls served from the disk cache are counted
+    separately, as cache hits).
+    Configuration server documents are cached on disk (CACHE_DIR, or ~/.cache/flylight)
+    for cache_ttl seconds, then revalidated with a conditional GET. Some documents
+    (e.g. db_config, aws) contain credentials, so the cache directory is created
+    owner-only and cache files are written with mode 0600.
+'''
+
+import json
+import logging
+import os
+import random
+import re
+import socket
+import threading
+from time import sleep, time
+from urllib.parse import urlsplit
+import requests
+from requests.adapters import HTTPAdapter
+
+__version__ = '1.0.0'
+
+# Client settings (see configure)
+SETTINGS = {'connect_timeout': 10, 'read_timeout': 120, 'retries': 5,
+            'backoff': 0.5, 'max_backoff': 30, 'pool_size': 10,
+            'cache_dir': os.environ.get('CACHE_DIR',
+                                        os.path.join(os.path.expanduser('~'), '.cache',
+                                                     'flylight')),
+            'cache_ttl': 3600, 'cache_refresh': False}
+IDEMPOTENT = ['GET', 'HEAD', 'PUT', 'DELETE', 'OPTIONS']
+RETRY_STATUS = [429, 500, 502, 503, 504]
+SESSIONS = dict()
+STATS = dict()
+REFRESHED = set()
+LOCK = threading.Lock()
+# Per-thread flag: True if the last call_responder was served from the disk cache
+LAST_CALL = threading.local()
+LOGGER = logging.getLogger(__name__)
+
+
+class ResponderError(Exception):
+    ''' Raised when a call fails after all retries '''
+
+
+def configure(**kwargs):
+    ''' Change client settings. Sessions created afterwards use the new pool size.
+        Keyword arguments:
+          connect_timeout: connection timeout (seconds)
+          read_timeout: read timeout (seconds)
+          retries: maximum number of retries for idempotent calls
+          backoff: base backoff delay (seconds)
+          max_backoff: maximum backoff delay (seconds)
+          pool_size: maximum number of pooled connections per server
+          cache_dir: directory for cached configuration documents
+          cache_ttl: seconds before a cached configuration document is revalidated
+                     (0 disables the cache)
+          cache_refresh: True to fetch every cached document again on first use
+        Returns:
+          None
+    '''
+    for key, value in kwargs.items():
+        if key not in SETTINGS:
+            raise ValueError("Unknown setting %s" % (key))
+        if value is not None:
+            SETTINGS[key] = value
+
+
+def get_session(url):
+    ''' Return the pooled session for a URL's server
+        Keyword arguments:
+          url: URL
+        Returns:
+          requests session
+    '''
+    parts = urlsplit(url)
+    server = '%s://%s' % (parts.scheme, parts.netloc)
+    with LOCK:
+        if server not in SESSIONS:
+            session = requests.Session()
+            adapter = HTTPAdapter(pool_connections=1, pool_maxsize=SETTINGS['pool_size'])
+            session.mount(server, adapter)
+            SESSIONS[server] = session
+        return SESSIONS[server]
+
+
+def stat_key(url, name=None):
+    ''' Return the key used to record latency for a URL. Numeric path components
+        and query strings are removed so that calls to the same endpoint share a key.
+        Keyword arguments:
+          url: URL
+          name: server name (if known)
+        Returns:
+          key
+    '''
+    parts = urlsplit(url)
+    path = re.sub(r'/\d+(?=/|$)', '/{id}', parts.path)
+    return '%s:%s' % (name if name else parts.netloc, path)
+
+
+def new_stat(key):
+    ''' Add an endpoint to STATS (call with LOCK held)
+        Keyword arguments:
+          key: endpoint key
+        Returns:
+          None
+    '''
+    if key not in STATS:
+        STATS[key] = {'calls': 0, 'errors': 0, 'retries': 0, 'seconds': 0.0, 'max': 0.0,
+                      'cached': 0}
+
+
+def record_hit(key):
+    ''' Record a call served from the disk cache in STATS
+        Keyword arguments:
+          key: endpoint key
+        Returns:
+          None
+    '''
+    with LOCK:
+        new_stat(key)
+        STATS[key]['cached'] += 1
+    LAST_CALL.cached = True
+
+
+def from_cache():
+    ''' Check if the last call_responder (in this thread) was served from the disk
+        cache, without calling the server
+        Keyword arguments:
+          None
+        Returns:
+          True if the response came from the cache
+    '''
+    return getattr(LAST_CALL, 'cached', False)
+
+
+def record(key, elapsed, error=False, retry=False):
+    ''' Record a call in STATS
+        Keyword arguments:
+          key: endpoint key
+          elapsed: call time (seconds)
+          error: True if the call failed
+          retry: True if the call will be retried
+        Returns:
+          None
+    '''
+    with LOCK:
+        new_stat(key)
+        STATS[key]['calls'] += 1
+        STATS[key]['seconds'] += elapsed
+        STATS[key]['max'] = max(STATS[key]['max'], elapsed)
+        if error:
+            STATS[key]['errors'] += 1
+        if retry:
+            STATS[key]['retries'] += 1
+
+
+def backoff(attempt):
+    ''' Sleep before a retry ("full jitter" exponential backoff)
+        Keyword arguments:
+          attempt: retry number (starting at 0)
+        Returns:
+          None
+    '''
+    sleep(random.uniform(0, min(SETTINGS['max_backoff'], SETTINGS['backoff'] * 2 ** attempt)))
+
+
+def request(method, url, name=None, retry=None, **kwargs):
+    ''' Make an HTTP request using the pooled session for the URL's server
+        Keyword arguments:
+          method: HTTP method
+          url: URL
+          name: server name (used for STATS)
+          retry: True to retry, False to never retry (default: retry idempotent methods)
+          kwargs: additional arguments for requests (headers, json, data, ...)
+        Returns:
+          requests response (which may have a non-200 status)
+    '''
+    method = method.upper()
+    if retry is None:
+        retry = method in IDEMPOTENT
+    retries = SETTINGS['retries'] if retry else 0
+    kwargs.setdefault('timeout', (SETTINGS['connect_timeout'], SETTINGS['read_timeout']))
+    key = stat_key(url, name)
+    session = get_session(url)
+    attempt = 0
+    while True:
+        start = time()
+        try:
+            resp = session.request(method, url, **kwargs)
+        except requests.exceptions.RequestException as err:
+            will_retry = attempt < retries
+            record(key, time() - start, True, will_retry)
+            if not will_retry:
+                raise ResponderError("%s %s failed: %s" % (method, url, err)) from err
+        else:
+            will_retry = resp.status_code in RETRY_STATUS and attempt < retries
+            record(key, time() - start, resp.status_code >= 400, will_retry)
+            if not will_retry:
+                return resp
+        backoff(attempt)
+        attempt += 1
+
+
+def cache_path(url):
+    ''' Return the cache file path for a URL
+        Keyword arguments:
+          url: URL
+        Returns:
+          file path
+    '''
+    parts = urlsplit(url)
+    name = re.sub(r'[^A-Za-z0-9_.-]+', '_', parts.netloc + parts.path + '_' + parts.query)
+    return os.path.join(SETTINGS['cache_dir'], name.strip('_') + '.json')
+
+
+def write_cache(path, entry):
+    ''' Atomically write a cache entry
+        Keyword arguments:
+          path: cache file path
+          entry: cache entry
+        Returns:
+          None
+    '''
+    try:
+        os.makedirs(os.path.dirname(path), mode=0o700, exist_ok=True)
+        # makedirs doesn't change the mode of an existing directory
+        os.chmod(os.path.dirname(path), 0o700)
+        tmp_path = '%s.%d.%d' % (path, os.getpid(), threading.get_ident())
+        fdesc = os.open(tmp_path, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o600)
+        with os.fdopen(fdesc, 'w') as cfile:
+            json.dump(entry, cfile)
+        os.replace(tmp_path, path)
+    except OSError as err:
+        LOGGER.warning("Could not write cache file %s: %s", path, err)
+
+
+def cached_get(url, name=None):
+    ''' Return the JSON for a URL from the on-disk cache. Entries older than the TTL
+        are revalidated with a conditional GET, and with cache_refresh each entry is
+        fetched again the first time it's used. If the server can't be reached, a
+        stale entry is used (unless the entry was to be refreshed).
+        Keyword arguments:
+          url: URL
+          name: server name (used for STATS)
+        Returns:
+          JSON response
+    '''
+    path = cache_path(url)
+    entry = None
+    try:
+        with open(path, 'r') as cfile:
+            entry = json.load(cfile)
+    except (OSError, ValueError):
+        pass
+    refresh = SETTINGS['cache_refresh'] and url not in REFRESHED
+    if entry and not refresh and time() - entry['fetched'] < SETTINGS['cache_ttl']:
+        record_hit(stat_key(url, name))
+        return entry['data']
+    headers = dict()
+    if entry and not refresh and entry.get('etag'):
+        headers['If-None-Match'] = entry['etag']
+    if entry and not refresh and entry.get('last_modified'):
+        headers['If-Modified-Since'] = entry['last_modified']
+    try:
+        resp = request('GET', url, name, headers=headers)
+    except ResponderError as err:
+        if not entry or refresh:
+            raise
+        LOGGER.warning("Using stale cached %s: %s", url, err)
+        return entry['data']
+    if resp.status_code == 304 and entry:
+        entry['fetched'] = time()
+    elif resp.status_code == 200:
+        entry = {'url': url, 'fetched': time(), 'etag': resp.headers.get('ETag'),
+                 'last_modified': resp.headers.get('Last-Modified'), 'data': resp.json()}
+    else:
+        raise ResponderError("Could not get response from %s: %s %s"
+                             % (url, resp.status_code, resp.text))
+    REFRESHED.add(url)
+    write_cache(path, entry)
+    return entry['data']
+
+
+def invalidate(url):
+    ''' Remove a URL from the on-disk cache
+        Keyword arguments:
+          url: URL
+        Returns:
+          None
+    '''
+    try:
+        os.remove(cache_path(url))
+    except FileNotFoundError:
+        pass
+
+
+def call_responder(config, server, endpoint, payload='', authenticate=False):
+    ''' Call a responder and return its JSON response
+        Keyword arguments:
+          config: REST services configuration
+          server: server
+          endpoint: REST endpoint
+          payload: payload for PUT requests
+          authenticate: pass along token (from JACS_JWT) in header
+        Returns:
+          JSON response
+    '''
+    url = (config[server]['url'] if server else '') + endpoint
+    LAST_CALL.cached = False
+    headers = dict()
+    if payload or authenticate:
+        headers = {"Content-Type": "application/json",
+                   "Authorization": "Bearer " + os.environ['JACS_JWT']}
+    if payload:
+        headers['Accept'] = 'application/json'
+        headers['host'] = socket.gethostname()
+        resp = request('PUT', url, server, headers=headers, json=payload)
+    elif server == 'config' and not authenticate and SETTINGS['cache_ttl']:
+        return cached_get(url, server)
+    else:
+        resp = request('GET', url, server, headers=headers)
+    if resp.status_code != 200:
+        raise ResponderError("Could not get response from %s: %s %s"
+                             % (url, resp.status_code, resp.text))
+    return resp.json()
+
+
+def report():
+    ''' Return a printable summary of STATS
+        Keyword arguments:
+          None
+        Returns:
+          summary text
+    '''
+    lines = ["%-50s %7s %6s %7s %6s %9s %9s" % ('Endpoint', 'Calls', 'Errors', 'Retries',
+                                                  'Cached', 'Avg (ms)', 'Max (ms)')]
+    with LOCK:
+        for key in sorted(STATS):
+            stat = STATS[key]
+            lines.append("%-50s %7d %6d %7d %6d %9.1f %9.1f"
+                         % (key, stat['calls'], stat['errors'], stat['retries'],
+                            stat['cached'], 1000 * stat['seconds'] / max(stat['calls'], 1),
+                            1000 * stat['max']))
+    return "\n".join(lines)
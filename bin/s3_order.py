@@ -0,0 +1,312 @@
+''' s3_order.py
+    Upload the files in one or more s3cp order files to AWS S3. Each line of an
+    order file is "<source file><TAB><bucket>/<object name>" (as written by
+    upload_cdms.py and denormalize_s3.py), optionally followed by <TAB>ACL=<acl>
+    and/or <TAB>Tagging=<tags> to set the object's ACL and tags. Objects get no
+    ACL or tags unless their line specifies them.
+    Files are uploaded by a pool of workers; files larger than the multipart chunk
+    size are uploaded in parts. Uploads that fail with throttling, server, or
+    connection errors are retried with exponential backoff; other errors (e.g.
+    AccessDenied or a bad Tagging setting) fail the line immediately.
+    Each completed line is appended to a completion log (<order file>.done by
+    default), and lines in the log are skipped, so an interrupted run can simply be
+    restarted. Lines that still fail are written to <order file>.failed.
+    The content type (and encoding, e.g. gzip for .json.gz) is taken from the
+    object name.
+'''
+
+import argparse
+from concurrent.futures import ThreadPoolExecutor, as_completed
+import mimetypes
+import os
+import random
+import sys
+import threading
+from time import sleep, time
+import boto3
+from boto3.exceptions import S3UploadFailedError
+from boto3.s3.transfer import TransferConfig
+from botocore.config import Config
+from botocore.exceptions import ClientError, ConnectionError as BotoConnectionError, \
+                               HTTPClientError
+import colorlog
+from tqdm import tqdm
+import metrics_lib as MT
+import responder_lib as RL
+
+__version__ = '1.0.0'
+# Configuration
+CONFIG = {'config': {'url': os.environ.get('CONFIG_SERVER_URL',
+                                           'http://config.int.janelia.org/')}}
+AWS = dict()
+S3_CLIENT = ''
+S3_SECONDS = 60 * 60 * 12
+TRANSFER_CONFIG = None
+# Maximum seconds to wait between retries
+MAX_BACKOFF = 60
+# S3 error codes worth retrying (as are 429/5xx responses and connection errors)
+RETRY_CODES = ['InternalError', 'RequestLimitExceeded', 'RequestTimeout', 'ServiceUnavailable',
+               'SlowDown', 'Throttling', 'ThrottlingException']
+# Per-object upload settings allowed in order files
+ORDER_SETTINGS = ['ACL', 'Tagging']
+COUNT = {'Lines': 0, 'Already done': 0, 'Uploaded': 0, 'Failed': 0, 'Retries': 0,
+         'Bad lines': 0, 'Bytes': 0}
+LOCK = threading.Lock()
+mimetypes.add_type('application/x-ndjson', '.ndjson')
+
+
+def call_responder(server, endpoint):
+    ''' Call a responder
+        Keyword arguments:
+          server: server
+          endpoint: REST endpoint
+        Returns:
+          JSON response
+    '''
+    try:
+        return RL.call_responder(CONFIG, server, endpoint)
+    except RL.ResponderError as err:
+        LOGGER.critical(err)
+        sys.exit(-1)
+
+
+def initialize_program():
+    ''' Initialize configuration, the S3 client, and the transfer configuration
+        Keyword arguments:
+          None
+        Returns:
+          None
+    '''
+    global AWS, CONFIG, S3_CLIENT, TRANSFER_CONFIG # pylint: disable=W0603
+    data = call_responder('config', 'config/rest_services')
+    CONFIG = data['config']
+    data = call_responder('config', 'config/aws')
+    AWS = data['config']
+    chunk = ARG.CHUNK * 1024 * 1024
+    TRANSFER_CONFIG = TransferConfig(multipart_threshold=chunk, multipart_chunksize=chunk,
+                                     max_concurrency=ARG.PART_WORKERS)
+    # Allow one pooled connection per part being uploaded
+    s3_config = Config(max_pool_connections=max(10, ARG.WORKERS * ARG.PART_WORKERS))
+    if ARG.MANIFOLD == 'dev':
+        S3_CLIENT = boto3.client('s3', config=s3_config)
+    else:
+        sts_client = boto3.client('sts')
+        aro = sts_client.assume_role(RoleArn=AWS['role_arn'],
+                                     RoleSessionName="AssumeRoleSession1",
+                                     DurationSeconds=S3_SECONDS)
+        credentials = aro['Credentials']
+        S3_CLIENT = boto3.client('s3',
+                                 aws_access_key_id=credentials['AccessKeyId'],
+                                 aws_secret_access_key=credentials['SecretAccessKey'],
+                                 aws_session_token=credentials['SessionToken'],
+                                 config=s3_config)
+
+
+def increment_counter(key, amount=1):
+    ''' Increment a counter (safe to call from upload workers)
+        Keyword arguments:
+          key: counter name
+          amount: amount to add
+        Returns:
+          None
+    '''
+    with LOCK:
+        COUNT[key] += amount
+
+
+def read_log(log_file):
+    ''' Read the lines that were completed by a previous run
+        Keyword arguments:
+          log_file: completion log
+        Returns:
+          set of completed lines
+    '''
+    if not os.path.isfile(log_file):
+        return set()
+    with open(log_file, 'r') as lfile:
+        done = set(line.rstrip('\n') for line in lfile if line.strip())
+    print("%d completed line(s) in %s" % (len(done), log_file))
+    return done
+
+
+def read_order(order_file, done):
+    ''' Read the transfers from an order file
+        Keyword arguments:
+          order_file: order file
+          done: set of completed lines
+        Returns:
+          list of (line, source file, bucket, object name, upload settings)
+    '''
+    transfers = list()
+    with open(order_file, 'r') as ofile:
+        for line in ofile:
+            line = line.rstrip('\n')
+            if not line.strip():
+                continue
+            increment_counter('Lines')
+            if line in done:
+                increment_counter('Already done')
+                continue
+            field = line.split('\t')
+            settings = dict(setting.split('=', 1) for setting in field[2:] if '=' in setting)
+            if len(field) < 2 or '/' not in field[1] or len(settings) != len(field) - 2 \
+               or not set(settings) <= set(ORDER_SETTINGS):
+                LOGGER.error("Bad order line: %s", line)
+                increment_counter('Bad lines')
+                continue
+            bucket, object_name = field[1].split('/', 1)
+            transfers.append((line, field[0], bucket, object_name, settings))
+    return transfers
+
+
+def retryable(err):
+    ''' Check if a failed upload should be retried: throttling, server errors, and
+        connection problems are; anything else (e.g. AccessDenied, NoSuchBucket, or
+        an InvalidArgument for a bad Tagging setting) won't succeed on a retry
+        Keyword arguments:
+          err: upload exception
+        Returns:
+          True if the upload should be retried
+    '''
+    if isinstance(err, S3UploadFailedError) and err.__context__:
+        # upload_file wraps the client error
+        err = err.__context__
+    if isinstance(err, (BotoConnectionError, HTTPClientError)):
+        return True
+    if isinstance(err, ClientError):
+        status = err.response.get('ResponseMetadata', {}).get('HTTPStatusCode') or 0
+        return err.response.get('Error', {}).get('Code') in RETRY_CODES \
+               or status == 429 or status >= 500
+    return isinstance(err, OSError) and not isinstance(err, PermissionError)
+
+
+def upload_file(source, bucket, object_name, settings):
+    ''' Upload a file to S3, retrying failed uploads with exponential backoff (only
+        if the error is retryable)
+        Keyword arguments:
+          source: source file
+          bucket: S3 bucket
+          object_name: S3 object name
+          settings: upload settings from the order file (ACL, Tagging)
+        Returns:
+          None if the upload succeeded, otherwise the error
+    '''
+    mimetype, encoding = mimetypes.guess_type(object_name)
+    payload = {'ContentType': mimetype or 'binary/octet-stream'}
+    if encoding:
+        payload['ContentEncoding'] = encoding
+    payload.update(settings)
+    for attempt in range(ARG.RETRIES + 1):
+        try:
+            nbytes = os.path.getsize(source)
+            start = time()
+            S3_CLIENT.upload_file(source, bucket, object_name, ExtraArgs=payload,
+                                  Config=TRANSFER_CONFIG)
+        except FileNotFoundError as err:
+            return err
+        except (ClientError, S3UploadFailedError, BotoConnectionError, HTTPClientError,
+                OSError) as err:
+            if attempt >= ARG.RETRIES or not retryable(err):
+                return err
+            delay = min(MAX_BACKOFF, 2 ** attempt) * random.uniform(0.5, 1)
+            LOGGER.warning("Retrying %s/%s in %.1fs: %s", bucket, object_name, delay, err)
+            increment_counter('Retries')
+            sleep(delay)
+            continue
+        MT.observe('s3_put', time() - start, nbytes)
+        increment_counter('Bytes', nbytes)
+        return None
+
+
+def process_order(order_file):
+    ''' Upload the files in an order file
+        Keyword arguments:
+          order_file: order file
+        Returns:
+          None
+    '''
+    log_file = ARG.LOG if ARG.LOG else order_file + '.done'
+    transfers = read_order(order_file, read_log(log_file))
+    print("%s: %d file(s) to upload" % (order_file, len(transfers)))
+    if not transfers:
+        return
+    failed = list()
+    with open(log_file, 'a') as lfile, ThreadPoolExecutor(ARG.WORKERS) as executor:
+        futures = {executor.submit(upload_file, source, bucket, object_name, settings): line
+                   for line, source, bucket, object_name, settings in transfers}
+        for future in tqdm(as_completed(futures), total=len(futures)):
+            line = futures[future]
+            err = future.result()
+            if err:
+                LOGGER.error("Could not upload %s: %s", line, err)
+                increment_counter('Failed')
+                failed.append(line)
+                continue
+            increment_counter('Uploaded')
+            lfile.write(line + "\n")
+            lfile.flush()
+    if failed:
+        failed_file = order_file + '.failed'
+        with open(failed_file, 'w') as ffile:
+            ffile.write("\n".join(failed) + "\n")
+        print("Failed lines were written to %s" % (failed_file))
+
+
+def run_orders():
+    ''' Upload the files in all order files and print a summary
+        Keyword arguments:
+          None
+        Returns:
+          None
+    '''
+    start = time()
+    for order_file in ARG.ORDER:
+        process_order(order_file)
+    elapsed = time() - start
+    for key in ['Lines', 'Already done', 'Uploaded', 'Failed', 'Retries', 'Bad lines']:
+        print("%-13s %d" % (key + ':', COUNT[key]))
+    print("Transferred %.2f MB in %.1f seconds (%.2f MB/s, %.2f files/s)"
+          % (COUNT['Bytes'] / 1e6, elapsed, COUNT['Bytes'] / 1e6 / max(elapsed, 1e-6),
+             COUNT['Uploaded'] / max(elapsed, 1e-6)))
+    if COUNT['Uploaded']:
+        print(MT.report())
+
+
+if __name__ == '__main__':
+    PARSER = argparse.ArgumentParser(description="Upload the files in s3cp order files")
+    PARSER.add_argument('--order', dest='ORDER', action='store', nargs='+', required=True,
+                        help='Order file(s)')
+    PARSER.add_argument('--log', dest='LOG', action='store',
+                        default='', help='Completion log (default <order file>.done)')
+    PARSER.add_argument('--workers', dest='WORKERS', action='store', type=int,
+                        default=8, help='Number of concurrent file uploads')
+    PARSER.add_argument('--part-workers', dest='PART_WORKERS', action='store', type=int,
+                        default=4, help='Number of concurrent part uploads per file')
+    PARSER.add_argument('--chunk', dest='CHUNK', action='store', type=int,
+                        default=8,
+                        help='Multipart threshold and part size (MB)')
+    PARSER.add_argument('--retries', dest='RETRIES', action='store', type=int,
+                        default=5, help='Maximum retries per file')
+    PARSER.add_argument('--manifold', dest='MANIFOLD', action='store',
+                        default='dev', help='S3 manifold')
+    PARSER.add_argument('--refresh-config', dest='REFRESH_CONFIG', action='store_true',
+                        default=False, help='Flag, Bypass the local configuration cache')
+    PARSER.add_argument('--verbose', dest='VERBOSE', action='store_true',
+                        default=False, help='Flag, Chatty')
+    PARSER.add_argument('--debug', dest='DEBUG', action='store_true',
+                        default=False, help='Flag, Very chatty')
+    ARG = PARSER.parse_args()
+    LOGGER = colorlog.getLogger()
+    if ARG.DEBUG:
+        LOGGER.setLevel(colorlog.colorlog.logging.DEBUG)
+    elif ARG.VERBOSE:
+        LOGGER.setLevel(colorlog.colorlog.logging.INFO)
+    else:
+        LOGGER.setLevel(colorlog.colorlog.logging.WARNING)
+    HANDLER = colorlog.StreamHandler()
+    HANDLER.setFormatter(colorlog.ColoredFormatter())
+    LOGGER.addHandler(HANDLER)
+    RL.configure(cache_refresh=ARG.REFRESH_CONFIG)
+    initialize_program()
+    run_orders()
+    sys.exit(1 if COUNT['Failed'] or COUNT['Bad lines'] else 0)
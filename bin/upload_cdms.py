@@ -3,29 +3,41 @@
 __version__ = '1.3.1'
 
 import argparse
+import copy
+from concurrent.futures import Future, ProcessPoolExecutor, ThreadPoolExecutor
 from datetime import datetime
 import glob
+import hashlib
+import io
 import json
+import multiprocessing
 import os
+import queue
 import re
-import socket
 import sys
+import tempfile
+import threading
 from time import strftime, time
 import boto3
+from boto3.s3.transfer import TransferConfig
+from botocore.config import Config
 from botocore.exceptions import ClientError
 import colorlog
 import inquirer
 import jwt
-import requests
 from simple_term_menu import TerminalMenu
 from tqdm import tqdm
 import MySQLdb
 from PIL import Image
 import neuronbridge_lib as NB
+import mapping_lib as ML
+import metrics_lib as MT
+import responder_lib as RL
 
 
 # Configuration
-CONFIG = {'config': {'url': 'http://config.int.janelia.org/'}}
+CONFIG = {'config': {'url': os.environ.get('CONFIG_SERVER_URL',
+                                         'http://config.int.janelia.org/')}}
 AWS = dict()
 CLOAD = dict()
 LIBRARY = dict()
@@ -34,24 +46,57 @@ WILL_LOAD = list()
 # Database
 CONN = dict()
 CURSOR = dict()
+DB_CONFIG = dict()
 # General use
 COUNT = {'Amazon S3 uploads': 0, 'Files to upload': 0, 'Samples': 0, 'No Consensus': 0,
          'No sampleRef': 0, 'No publishing name': 0, 'No driver': 0, 'Not published': 0,
          'Skipped': 0, 'Already on S3': 0, 'Already on JACS': 0, 'Bad driver': 0,
          'Duplicate objects': 0, 'Unparsable files': 0, 'Updated on JACS': 0,
-         'FlyEM flips': 0, 'Images': 0}
-SUBDIVISION = {'prefix': 1, 'counter': 0, 'limit': 100}
+         'FlyEM flips': 0, 'Images': 0, 'Unchanged on S3': 0, 'Not in subdivision plan': 0,
+         'Failed uploads': 0}
+# searchable_neurons subdivision for each source file (see plan_subdivisions)
+SUBDIVISION = {'batch_size': 100, 'prefix': dict()}
+PLAN_VERSION = 1
 TRANSACTIONS = dict()
 PNAME = dict()
 REC = {'line': '', 'slide_code': '', 'gender': '', 'objective': '', 'area': ''}
 S3_CLIENT = S3_RESOURCE = ''
 FULL_NAME = TAGS = ''
 MAX_SIZE = 500
+# In-memory images larger than this are spooled to a temp file
+SPOOL_SIZE = 32 * 1024 * 1024
 CREATE_THUMBNAIL = False
 S3_SECONDS = 60 * 60 * 12
+# Number of keys per IN (...) list for --pushdown queries
+PUSHDOWN_BATCH = 1000
+# Multipart settings for uploads (these determine the ETag of large files)
+MULTIPART_CHUNK = 8 * 1024 * 1024
+TRANSFER_CONFIG = TransferConfig(multipart_threshold=MULTIPART_CHUNK,
+                                 multipart_chunksize=MULTIPART_CHUNK)
 VARIANT_UPLOADS = dict()
 UPLOADED_NAME = dict()
 KEY_LIST = list()
+# Concurrent uploads and image conversion
+EXECUTOR = CONVERTER = JACS_EXECUTOR = None
+PENDING = dict()
+# Pending render jobs, keyed by output path
+RENDERS = dict()
+ABORT = threading.Event()
+LOCK = {'count': threading.Lock(), 'error': threading.Lock(), 'journal': threading.Lock(),
+        'chunk': threading.Lock(), 's3cp': threading.Lock()}
+# Dask actor that keeps object names and subdivisions consistent (with --dask-scheduler)
+COORDINATOR = None
+# Objects claimed for this chunk by claim_chunk (source path if another chunk has them)
+CLAIMED = dict()
+# Pipeline stages (read, convert, upload, jacs), keyed by name (see add_stage)
+STAGES = dict()
+# Maximum number of samples parsed ahead of processing (with --stream)
+READ_AHEAD = 256
+# Upload journal (for --resume)
+JOURNAL = {'file': '', 'handle': None, 'S3': set(), 'JACS': set(), 'unsynced': 0, 'synced': time()}
+JOURNAL_SYNC = {'records': 500, 'seconds': 10}
+# Existing S3 objects (for --check), keyed by bucket and prefix
+S3_INVENTORY = dict()
 
 
 def terminate_program(code):
@@ -61,17 +106,115 @@ def terminate_program(code):
         Returns:
           None
     '''
+    if threading.current_thread() is not threading.main_thread():
+        # Called from a worker: let the main thread shut down
+        ABORT.set()
+        sys.exit(code)
+    try:
+        MT.stop()
+    except OSError as err:
+        LOGGER.error("Could not write metrics: %s", err)
+    close_journal()
     if S3CP:
         ERR.close()
         S3CP.close()
-        if not os.path.getsize(S3CP_FILE):
-            os.remove(S3CP_FILE)
         for fpath in [ERR_FILE, S3CP_FILE]:
             if not os.path.getsize(fpath):
                 os.remove(fpath)
     sys.exit(code)
 
 
+def increment_counter(counter, key, amount=1):
+    ''' Increment a counter in a thread-safe manner
+        Keyword arguments:
+          counter: counter dictionary (COUNT, TRANSACTIONS, VARIANT_UPLOADS)
+          key: counter key
+          amount: amount to add
+        Returns:
+          None
+    '''
+    with LOCK['count']:
+        if key not in counter:
+            counter[key] = amount
+        else:
+            counter[key] += amount
+
+
+def open_journal(journal_file):
+    ''' Open the upload journal for appending. If resuming, first read the completed
+        S3 uploads and JACS updates from it.
+        Keyword arguments:
+          journal_file: journal file path
+        Returns:
+          None
+    '''
+    if ARG.RESUME:
+        if not os.path.isfile(journal_file):
+            LOGGER.critical("Journal %s does not exist", journal_file)
+            terminate_program(-1)
+        with open(journal_file, 'r') as jfile:
+            for line in jfile:
+                fields = line.rstrip('\n').split('\t')
+                # Ignore a partially-written last line
+                if len(fields) == 2 and fields[0] in ('S3', 'JACS'):
+                    JOURNAL[fields[0]].add(fields[1])
+        print("Resuming from %s: %d S3 uploads, %d JACS updates already complete"
+              % (journal_file, len(JOURNAL['S3']), len(JOURNAL['JACS'])))
+    if ARG.AWS and ARG.WRITE:
+        JOURNAL['file'] = journal_file
+        JOURNAL['handle'] = open(journal_file, 'a')
+
+
+def journal_record(kind, value):
+    ''' Append a completed operation to the journal. The journal is synced to disk
+        in batches.
+        Keyword arguments:
+          kind: "S3" (value is bucket/object) or "JACS" (value is sample ID)
+          value: completed item
+        Returns:
+          None
+    '''
+    with LOCK['journal']:
+        if not JOURNAL['handle']:
+            return
+        JOURNAL['handle'].write("%s\t%s\n" % (kind, value))
+        JOURNAL['unsynced'] += 1
+        if JOURNAL['unsynced'] >= JOURNAL_SYNC['records'] \
+           or time() - JOURNAL['synced'] >= JOURNAL_SYNC['seconds']:
+            sync_journal()
+
+
+def sync_journal():
+    ''' Flush the journal to disk. The caller must hold the journal lock.
+        Keyword arguments:
+          None
+        Returns:
+          None
+    '''
+    JOURNAL['handle'].flush()
+    if JOURNAL['file']:
+        os.fsync(JOURNAL['handle'].fileno())
+    JOURNAL['unsynced'] = 0
+    JOURNAL['synced'] = time()
+
+
+def close_journal():
+    ''' Sync and close the journal
+        Keyword arguments:
+          None
+        Returns:
+          None
+    '''
+    with LOCK['journal']:
+        if not JOURNAL['handle']:
+            return
+        sync_journal()
+        JOURNAL['handle'].close()
+        JOURNAL['handle'] = None
+    if not os.path.getsize(JOURNAL['file']):
+        os.remove(JOURNAL['file'])
+
+
 def call_responder(server, endpoint, payload='', authenticate=False):
     ''' Call a responder
         Keyword arguments:
@@ -82,32 +225,16 @@ def call_responder(server, endpoint, payload='', authenticate=False):
         Returns:
           JSON response
     '''
-    if not server in TRANSACTIONS:
-        TRANSACTIONS[server] = 1
-    else:
-        TRANSACTIONS[server] += 1
-    url = (CONFIG[server]['url'] if server else '') + endpoint
     try:
-        if payload or authenticate:
-            headers = {"Content-Type": "application/json",
-                       "Authorization": "Bearer " + os.environ['JACS_JWT']}
-        if payload:
-            headers['Accept'] = 'application/json'
-            headers['host'] = socket.gethostname()
-            req = requests.put(url, headers=headers, json=payload)
-        else:
-            if authenticate:
-                req = requests.get(url, headers=headers)
-            else:
-                req = requests.get(url)
-    except requests.exceptions.RequestException as err:
+        data = RL.call_responder(CONFIG, server, endpoint, payload, authenticate)
+    except RL.ResponderError as err:
+        increment_counter(TRANSACTIONS, server)
         LOGGER.critical(err)
         terminate_program(-1)
-    if req.status_code == 200:
-        return req.json()
-    print("Could not get response from %s: %s" % (url, req.text))
-    terminate_program(-1)
-    return False
+    # Only count calls that went to the server
+    if not RL.from_cache():
+        increment_counter(TRANSACTIONS, server)
+    return data
 
 
 def sql_error(err):
@@ -160,8 +287,10 @@ def initialize_s3():
     """
     global S3_CLIENT, S3_RESOURCE # pylint: disable=W0603
     LOGGER.info("Opening S3 client and resource")
+    # Allow one pooled connection per upload worker
+    s3_config = Config(max_pool_connections=max(10, ARG.WORKERS))
     if ARG.MANIFOLD == 'dev':
-        S3_CLIENT = boto3.client('s3')
+        S3_CLIENT = boto3.client('s3', config=s3_config)
         S3_RESOURCE = boto3.resource('s3')
     else:
         sts_client = boto3.client('sts')
@@ -172,7 +301,8 @@ def initialize_s3():
         S3_CLIENT = boto3.client('s3',
                                  aws_access_key_id=credentials['AccessKeyId'],
                                  aws_secret_access_key=credentials['SecretAccessKey'],
-                                 aws_session_token=credentials['SessionToken'])
+                                 aws_session_token=credentials['SessionToken'],
+                                 config=s3_config)
         S3_RESOURCE = boto3.resource('s3',
                                      aws_access_key_id=credentials['AccessKeyId'],
                                      aws_secret_access_key=credentials['SecretAccessKey'],
@@ -242,7 +372,7 @@ def select_uploads():
 def initialize_program():
     """ Initialize
     """
-    global AWS, CLOAD, CONFIG, FULL_NAME, LIBRARY, TAGS # pylint: disable=W0603
+    global AWS, CLOAD, CONFIG, DB_CONFIG, FULL_NAME, LIBRARY, TAGS # pylint: disable=W0603
     data = call_responder('config', 'config/rest_services')
     CONFIG = data['config']
     data = call_responder('config', 'config/upload_cdms')
@@ -256,7 +386,7 @@ def initialize_program():
     TAGS = 'PROJECT=CDCS&STAGE=' + ARG.MANIFOLD + '&DEVELOPER=svirskasr&' \
            + 'VERSION=' + __version__
     data = call_responder('config', 'config/db_config')
-    (CONN['sage'], CURSOR['sage']) = db_connect(data['config']['sage']['prod'])
+    DB_CONFIG = data['config']
     if ARG.LIBRARY not in LIBRARY:
         LOGGER.critical("Unknown library %s", ARG.LIBRARY)
         terminate_program(-1)
@@ -280,7 +410,8 @@ def log_error(err_text):
           None
     '''
     LOGGER.error(err_text)
-    ERR.write(err_text + "\n")
+    with LOCK['error']:
+        ERR.write(err_text + "\n")
 
 
 def get_s3_names(bucket, newname):
@@ -302,7 +433,211 @@ def get_s3_names(bucket, newname):
     return bucket, object_name
 
 
-def upload_aws(bucket, dirpath, fname, newname, force=False):
+def get_s3_inventory(bucket, object_name):
+    ''' Return the inventory of existing objects under an object's
+        <alignment space>/<library>/ prefix. The prefix is listed once, the first
+        time it is needed.
+        Keyword arguments:
+          bucket: S3 bucket
+          object_name: S3 object name
+        Returns:
+          dictionary of object key: (size, ETag)
+    '''
+    prefix = '/'.join(object_name.split('/')[0:2]) + '/'
+    if (bucket, prefix) not in S3_INVENTORY:
+        LOGGER.info("Listing existing objects in %s/%s", bucket, prefix)
+        inventory = dict()
+        try:
+            for obj in NB.get_all_s3_objects(S3_CLIENT, Bucket=bucket, Prefix=prefix):
+                inventory[obj['Key']] = (obj['Size'], obj['ETag'].strip('"'))
+        except ClientError as err:
+            LOGGER.critical(err)
+            terminate_program(-1)
+        LOGGER.info("Found %d objects in %s/%s", len(inventory), bucket, prefix)
+        S3_INVENTORY[(bucket, prefix)] = inventory
+    return S3_INVENTORY[(bucket, prefix)]
+
+
+def already_on_s3(bucket, object_name, complete_fpath):
+    ''' Determine if an object is already on S3 with the same size as the local file.
+        Images that haven't been rendered yet are only checked for existence.
+        Keyword arguments:
+          bucket: S3 bucket
+          object_name: S3 object name
+          complete_fpath: local file path
+        Returns:
+          True if the object is already on S3
+    '''
+    inventory = get_s3_inventory(bucket, object_name)
+    if object_name not in inventory:
+        return False
+    if complete_fpath in RENDERS:
+        return True
+    try:
+        local_size = os.path.getsize(complete_fpath)
+    except OSError:
+        return False
+    if local_size != inventory[object_name][0]:
+        LOGGER.warning("%s is on S3 with a different size (%d vs %d)", object_name,
+                       inventory[object_name][0], local_size)
+        return False
+    return True
+
+
+class UploadCoordinator:
+    ''' Dask actor (see process_on_dask) that keeps the uploaded object names
+        consistent across all chunks
+    '''
+
+    def __init__(self):
+        self.uploaded = dict()
+
+    def claim(self, object_name, complete_fpath):
+        ''' Record the source of an object
+            Keyword arguments:
+              object_name: S3 object name
+              complete_fpath: source file path
+            Returns:
+              source file path if the object was already claimed, otherwise None
+        '''
+        previous = self.uploaded.get(object_name)
+        if not previous:
+            self.uploaded[object_name] = complete_fpath
+        return previous
+
+    def claim_batch(self, objects):
+        ''' Record the sources of a chunk's objects
+            Keyword arguments:
+              objects: list of (S3 object name, source file path)
+            Returns:
+              dictionary of source file paths for the objects that were already
+              claimed (by another chunk); the rest are now claimed
+        '''
+        previous = dict()
+        claimed = set()
+        for object_name, complete_fpath in objects:
+            if object_name in claimed:
+                continue
+            claimed.add(object_name)
+            if object_name in self.uploaded:
+                previous[object_name] = self.uploaded[object_name]
+            else:
+                self.uploaded[object_name] = complete_fpath
+        return previous
+
+    def release(self, objects):
+        ''' Drop claims (from claim_batch) for objects that weren't uploaded
+            Keyword arguments:
+              objects: list of (S3 object name, source file path)
+            Returns:
+              None
+        '''
+        for object_name, complete_fpath in objects:
+            if self.uploaded.get(object_name) == complete_fpath:
+                del self.uploaded[object_name]
+
+
+def plan_subdivisions(data):
+    ''' Plan the searchable_neurons subdivisions for a set of samples. Source files
+        are sorted by path and split into batches of ARG.BATCH_SIZE, so a file's
+        subdivision only depends on the JSON file (not on processing order, --samples,
+        or which files were already uploaded).
+        Keyword arguments:
+          data: samples (list or generator)
+        Returns:
+          plan dictionary
+    '''
+    paths = set()
+    for smp in data:
+        if 'variants' in smp and smp['variants'].get('searchable_neurons'):
+            paths.add(smp['variants']['searchable_neurons'])
+    paths = sorted(paths)
+    return {'version': PLAN_VERSION, 'json': os.path.basename(ARG.JSON),
+            'batch_size': ARG.BATCH_SIZE, 'batch_count': -(-len(paths) // ARG.BATCH_SIZE),
+            'count': len(paths), 'paths': paths}
+
+
+def load_subdivisions(data):
+    ''' Read the searchable_neurons subdivision plan from ARG.SUBDIVISION_PLAN if it
+        exists, otherwise plan it from the samples and write it (to ARG.SUBDIVISION_PLAN
+        or <library>_subdivisions_<timestamp>.json). The plan covers the whole JSON
+        file (regardless of --samples), so its subdivisions don't depend on how much
+        of the file is processed; with --stream, planning is a separate pass over the
+        file (--plan-pass) that must finish before the first upload. The plan's
+        batch_size and batch_count can be passed to denormalize_s3
+        (--subdivision-plan).
+        Keyword arguments:
+          data: samples (list or generator)
+        Returns:
+          None
+    '''
+    if ARG.SUBDIVISION_PLAN and os.path.isfile(ARG.SUBDIVISION_PLAN):
+        try:
+            with open(ARG.SUBDIVISION_PLAN, 'r') as pfile:
+                plan = json.load(pfile)
+        except (OSError, ValueError) as err:
+            LOGGER.critical("Could not read subdivision plan %s: %s", ARG.SUBDIVISION_PLAN, err)
+            terminate_program(-1)
+        if plan.get('version') != PLAN_VERSION:
+            LOGGER.critical("Subdivision plan %s has unsupported version %s",
+                            ARG.SUBDIVISION_PLAN, plan.get('version'))
+            terminate_program(-1)
+        print("Using subdivision plan %s" % (ARG.SUBDIVISION_PLAN))
+    else:
+        if ARG.BATCH_SIZE < 1:
+            LOGGER.critical("--batch-size must be at least 1")
+            terminate_program(-1)
+        plan = plan_subdivisions(data)
+        plan_file = ARG.SUBDIVISION_PLAN if ARG.SUBDIVISION_PLAN \
+                    else '%s_subdivisions_%s.json' % (ARG.LIBRARY, STAMP)
+        with open(plan_file, 'w') as pfile:
+            json.dump(plan, pfile)
+        print("Wrote subdivision plan %s" % (plan_file))
+    SUBDIVISION['batch_size'] = plan['batch_size']
+    SUBDIVISION['prefix'] = {path: idx // plan['batch_size'] + 1
+                             for idx, path in enumerate(plan['paths'])}
+    print("searchable_neurons files: %d in %d subdivisions of %d"
+          % (plan['count'], plan['batch_count'], plan['batch_size']))
+
+
+def get_subdivision(smp):
+    ''' Return the planned subdivision for a sample's searchable_neurons file
+        Keyword arguments:
+          smp: sample record
+        Returns:
+          subdivision prefix, or None if the file isn't in the plan
+    '''
+    prefix = SUBDIVISION['prefix'].get(smp['variants']['searchable_neurons'])
+    if not prefix:
+        log_error("%s is not in the subdivision plan" % (smp['variants']['searchable_neurons']))
+        COUNT['Not in subdivision plan'] += 1
+        return None
+    return str(prefix)
+
+
+def claim_upload(object_name, complete_fpath):
+    ''' Record the source of an object that's about to be uploaded
+        Keyword arguments:
+          object_name: S3 object name
+          complete_fpath: source file path
+        Returns:
+          source file path if the object was already uploaded, otherwise None
+    '''
+    previous = UPLOADED_NAME.get(object_name)
+    if previous:
+        return previous
+    if COORDINATOR:
+        if object_name in CLAIMED:
+            previous = CLAIMED[object_name]
+        else:
+            # claim_chunk couldn't predict this object
+            previous = COORDINATOR.claim(object_name, complete_fpath).result()
+    if not previous:
+        UPLOADED_NAME[object_name] = complete_fpath
+    return previous
+
+
+def upload_aws(bucket, dirpath, fname, newname, force=False, track=False):
     ''' Transfer a file to Amazon S3
         Keyword arguments:
           bucket: S3 bucket
@@ -310,6 +645,7 @@ def upload_aws(bucket, dirpath, fname, newname, force=False):
           fname: file name
           newname: new file name
           force: force upload (regardless of AWS parm)
+          track: keep the queued upload so after_upload can wait for it
         Returns:
           url
     '''
@@ -317,29 +653,39 @@ def upload_aws(bucket, dirpath, fname, newname, force=False):
     complete_fpath = '/'.join([dirpath, fname])
     bucket, object_name = get_s3_names(bucket, newname)
     LOGGER.debug("Uploading %s to S3 as %s", complete_fpath, object_name)
-    if object_name in UPLOADED_NAME:
-        if complete_fpath != UPLOADED_NAME[object_name]:
+    previous = claim_upload(object_name, complete_fpath)
+    if previous:
+        if complete_fpath != previous:
             err_text = "%s was already uploaded from %s, but is now being uploaded from %s" \
-                       % (object_name, UPLOADED_NAME[object_name], complete_fpath)
-            LOGGER.error(err_text)
-            ERR.write(err_text + "\n")
+                       % (object_name, previous, complete_fpath)
+            log_error(err_text)
             COUNT['Duplicate objects'] += 1
             return False
         LOGGER.debug("Already uploaded %s", object_name)
         COUNT['Duplicate objects'] += 1
         return 'Skipped'
-    UPLOADED_NAME[object_name] = complete_fpath
     url = '/'.join([AWS['base_aws_url'], bucket, object_name])
     url = url.replace(' ', '+')
     if "/searchable_neurons/" in object_name:
         KEY_LIST.append(object_name)
-    S3CP.write("%s\t%s\n" % (complete_fpath, '/'.join([bucket, object_name])))
+    if '/'.join([bucket, object_name]) in JOURNAL['S3']:
+        LOGGER.debug("%s was uploaded in a previous run", object_name)
+        COUNT['Already on S3'] += 1
+        return url
+    if ARG.CHECK and already_on_s3(bucket, object_name, complete_fpath):
+        LOGGER.debug("%s is already on S3", object_name)
+        COUNT['Already on S3'] += 1
+        return url
+    job = RENDERS.get(complete_fpath)
+    conversion = start_render(complete_fpath)
     LOGGER.info("Upload %s", object_name)
     COUNT['Images'] += 1
     if (not ARG.AWS) and (not force):
+        write_order(complete_fpath, bucket, object_name)
         return url
     if not ARG.WRITE:
-        COUNT['Amazon S3 uploads'] += 1
+        write_order(complete_fpath, bucket, object_name)
+        increment_counter(COUNT, 'Amazon S3 uploads')
         return url
     if newname.endswith('.png'):
         mimetype = 'image/png'
@@ -347,60 +693,513 @@ def upload_aws(bucket, dirpath, fname, newname, force=False):
         mimetype = 'image/jpeg'
     else:
         mimetype = 'image/tiff'
+    remote = get_s3_inventory(bucket, object_name).get(object_name) if ARG.CHANGED else None
+    if not (job and job['memory']):
+        job = None
+    if EXECUTOR:
+        stage_acquire('upload')
+        if conversion:
+            future = queue_transfer(conversion, complete_fpath, bucket, object_name, mimetype,
+                                    remote)
+        else:
+            future = EXECUTOR.submit(transfer_file, complete_fpath, bucket, object_name, mimetype,
+                                     remote, job)
+        future.add_done_callback(upload_done)
+        if track:
+            PENDING[url] = future
+        return url
+    if conversion and conversion.exception():
+        LOGGER.critical(conversion.exception())
+        increment_counter(COUNT, 'Failed uploads')
+        return False
+    if not transfer_file(complete_fpath, bucket, object_name, mimetype, remote, job):
+        increment_counter(COUNT, 'Failed uploads')
+        return False
+    return url
+
+
+def write_order(complete_fpath, bucket, object_name):
+    ''' Add an upload to the s3cp order file (for s3_order.py). This may be run
+        from an upload worker.
+        Keyword arguments:
+          complete_fpath: source file path
+          bucket: S3 bucket
+          object_name: S3 object name
+        Returns:
+          None
+    '''
+    # Uploads are public on prod (see transfer_file)
+    with LOCK['s3cp']:
+        S3CP.write("%s\t%s%s\n" % (complete_fpath, '/'.join([bucket, object_name]),
+                                   "\tACL=public-read" if ARG.MANIFOLD == 'prod' else ''))
+
+
+def upload_done(future):
+    ''' Release a queued upload's stage slot and count it if it failed
+        Keyword arguments:
+          future: upload future
+        Returns:
+          None
+    '''
+    stage_release('upload')
+    if future.exception():
+        log_error("Upload failed: %s" % (future.exception()))
+    if future.exception() or not future.result():
+        increment_counter(COUNT, 'Failed uploads')
+
+
+def queue_transfer(conversion, *args):
+    ''' Queue an upload to run once the image conversion that produces its file
+        has completed
+        Keyword arguments:
+          conversion: conversion future
+          args: arguments to transfer_file
+        Returns:
+          Future for the upload
+    '''
+    future = Future()
+
+    def copy_result(upload):
+        if upload.exception():
+            future.set_exception(upload.exception())
+        else:
+            future.set_result(upload.result())
+
+    def submit(_):
+        if conversion.exception():
+            LOGGER.error("Could not convert %s: %s", args[0], conversion.exception())
+            future.set_result(False)
+            return
+        EXECUTOR.submit(transfer_file, *args).add_done_callback(copy_result)
+
+    conversion.add_done_callback(submit)
+    return future
+
+
+def calculate_etag(sfile, remote_etag):
+    ''' Calculate the S3 ETag for a local file. If the remote ETag is from a multipart
+        upload, the ETag is computed from the MD5s of MULTIPART_CHUNK-sized parts.
+        Keyword arguments:
+          sfile: binary file object, positioned at the start
+          remote_etag: ETag of the existing S3 object
+        Returns:
+          ETag, or None if the part count does not match the remote ETag
+    '''
+    digests = list()
+    whole = hashlib.md5()
+    for data in iter(lambda: sfile.read(MULTIPART_CHUNK), b''):
+        if '-' in remote_etag:
+            digests.append(hashlib.md5(data).digest())
+        else:
+            whole.update(data)
+    if '-' not in remote_etag:
+        return whole.hexdigest()
+    if str(len(digests)) != remote_etag.split('-')[-1]:
+        return None
+    return '%s-%d' % (hashlib.md5(b''.join(digests)).hexdigest(), len(digests))
+
+
+def unchanged_on_s3(complete_fpath, remote, body=None):
+    ''' Determine if a local file has the same content as an existing S3 object
+        Keyword arguments:
+          complete_fpath: local file path
+          remote: (size, ETag) of the existing S3 object
+          body: in-memory file object to use instead of the local file
+        Returns:
+          True if the content is unchanged
+    '''
     try:
+        if body:
+            size = body.seek(0, io.SEEK_END)
+            body.seek(0)
+            return size == remote[0] and calculate_etag(body, remote[1]) == remote[1]
+        if os.path.getsize(complete_fpath) != remote[0]:
+            return False
+        with open(complete_fpath, 'rb') as sfile:
+            return calculate_etag(sfile, remote[1]) == remote[1]
+    except OSError as err:
+        LOGGER.warning("Could not hash %s: %s", complete_fpath, err)
+        return False
+
+
+def transfer_file(complete_fpath, bucket, object_name, mimetype, remote=None, job=None):
+    ''' Upload a single file to Amazon S3 (and add it to the s3cp order file, unless
+        it's unchanged on S3). This may be run from an upload worker.
+        Keyword arguments:
+          complete_fpath: source file path
+          bucket: S3 bucket
+          object_name: S3 object name
+          mimetype: content type
+          remote: (size, ETag) of the existing S3 object (with --changed)
+          job: in-memory render job that produces the file
+        Returns:
+          True for success, False otherwise
+    '''
+    body = None
+    try:
+        if job:
+            body = take_rendered(job, complete_fpath)
+        if remote and unchanged_on_s3(complete_fpath, remote, body):
+            LOGGER.debug("%s is unchanged on S3", object_name)
+            increment_counter(COUNT, 'Unchanged on S3')
+            journal_record('S3', '/'.join([bucket, object_name]))
+            return True
+        write_order(complete_fpath, bucket, object_name)
         payload = {'ContentType': mimetype}
         if ARG.MANIFOLD == 'prod':
             payload['ACL'] = 'public-read'
-        S3_CLIENT.upload_file(complete_fpath, bucket,
-                              object_name,
-                              ExtraArgs=payload)
-    except ClientError as err:
+        start = time()
+        if body:
+            nbytes = body.seek(0, io.SEEK_END)
+            body.seek(0)
+            S3_CLIENT.upload_fileobj(body, bucket,
+                                     object_name,
+                                     ExtraArgs=payload,
+                                     Config=TRANSFER_CONFIG)
+        else:
+            nbytes = os.path.getsize(complete_fpath)
+            S3_CLIENT.upload_file(complete_fpath, bucket,
+                                  object_name,
+                                  ExtraArgs=payload,
+                                  Config=TRANSFER_CONFIG)
+        MT.observe('s3_put', time() - start, nbytes)
+    except (ClientError, OSError) as err:
         LOGGER.critical(err)
         return False
-    COUNT['Amazon S3 uploads'] += 1
-    return url
+    finally:
+        if body:
+            body.close()
+    increment_counter(COUNT, 'Amazon S3 uploads')
+    journal_record('S3', '/'.join([bucket, object_name]))
+    return True
 
 
-def get_line_mapping():
-    ''' Create a mapping of publishing names to drivers. Note that "GAL4-Collection"
-        is remapped to "GAL4".
+def after_upload(urls, func, *args):
+    ''' Run a function once the uploads for a list of URLs have completed. If the
+        uploads were not queued (no workers), the function is run immediately.
         Keyword arguments:
+          urls: list of URLs returned by upload_aws
+          func: function to call with (success, *args)
+          args: additional arguments to func
+        Returns:
           None
+    '''
+    futures = [PENDING.pop(url) for url in urls if url in PENDING]
+    if not futures:
+        func(True, *args)
+        return
+    remaining = {'count': len(futures)}
+    lock = threading.Lock()
+
+    def done(_):
+        with lock:
+            remaining['count'] -= 1
+            if remaining['count']:
+                return
+        success = all(fut.exception() is None and fut.result() for fut in futures)
+        try:
+            func(success, *args)
+        except SystemExit:
+            ABORT.set()
+        except Exception as err: # pylint: disable=broad-except
+            log_error("Post-upload processing failed: %s" % (str(err)))
+            ABORT.set()
+
+    for fut in futures:
+        fut.add_done_callback(done)
+
+
+def add_stage(name, workers, bound=0):
+    ''' Add a pipeline stage. Each stage has its own concurrency and a bounded
+        queue: submitting to a full stage blocks (backpressure), and the time spent
+        blocked is recorded so the bottleneck can be found.
+        Keyword arguments:
+          name: stage name
+          workers: number of concurrent workers
+          bound: maximum number of queued and running items
+                 (default: workers * ARG.QUEUE_FACTOR)
         Returns:
-          driver dictionary
+          None
+    '''
+    bound = bound if bound else workers * max(ARG.QUEUE_FACTOR, 1)
+    STAGES[name] = {'workers': workers, 'bound': bound,
+                    'slots': threading.BoundedSemaphore(bound),
+                    'queued': 0, 'peak': 0, 'done': 0, 'blocked': 0.0}
+
+
+def stage_acquire(name, stop=None):
+    ''' Wait for room in a stage's queue
+        Keyword arguments:
+          name: stage name
+          stop: event that ends the wait early
+        Returns:
+          True if a queue slot was acquired
+    '''
+    stage = STAGES[name]
+    start = time()
+    while not stage['slots'].acquire(timeout=1):
+        if stop and stop.is_set():
+            return False
+    with LOCK['count']:
+        stage['blocked'] += time() - start
+        stage['queued'] += 1
+        stage['peak'] = max(stage['peak'], stage['queued'])
+    return True
+
+
+def stage_release(name):
+    ''' Mark an item in a stage as complete and free its queue slot
+        Keyword arguments:
+          name: stage name
+        Returns:
+          None
+    '''
+    stage = STAGES[name]
+    with LOCK['count']:
+        stage['queued'] -= 1
+        stage['done'] += 1
+    stage['slots'].release()
+
+
+def stage_status():
+    ''' Return the current queue depth of each stage
+        Keyword arguments:
+          None
+        Returns:
+          status text
+    '''
+    return ' '.join(["%s %d/%d" % (name, stage['queued'], stage['bound'])
+                     for name, stage in STAGES.items()])
+
+
+def stage_report():
+    ''' Return a printable summary of the pipeline stages. "Blocked" is the time
+        spent waiting for room in a stage's queue; the stage with the most blocked
+        time is the bottleneck.
+        Keyword arguments:
+          None
+        Returns:
+          summary text
+    '''
+    lines = ["%-10s %7s %7s %7s %9s %11s" % ('Stage', 'Workers', 'Queue', 'Peak', 'Done',
+                                             'Blocked (s)')]
+    for name, stage in STAGES.items():
+        lines.append("%-10s %7d %7d %7d %9d %11.1f"
+                     % (name, stage['workers'], stage['bound'], stage['peak'], stage['done'],
+                        stage['blocked']))
+    return "\n".join(lines)
+
+
+def run_metrics():
+    ''' Return the run counters and queue depths for the metrics files
+        Keyword arguments:
+          None
+        Returns:
+          metrics dictionary
+    '''
+    with LOCK['count']:
+        return {'counts': dict(COUNT),
+                'queues': {name: stage['queued'] for name, stage in STAGES.items()}}
+
+
+def read_ahead(data):
+    ''' Parse samples in a reader thread, up to READ_AHEAD samples ahead of
+        processing
+        Keyword arguments:
+          data: samples (generator)
+        Returns:
+          Generator of samples
+    '''
+    add_stage('read', 1, READ_AHEAD)
+    samples = queue.Queue()
+    stop = threading.Event()
+
+    def produce():
+        try:
+            for smp in data:
+                if not stage_acquire('read', stop):
+                    return
+                samples.put(smp)
+        except SystemExit:
+            pass
+        except Exception as err: # pylint: disable=broad-except
+            log_error("Could not read samples: %s" % (str(err)))
+            ABORT.set()
+        finally:
+            samples.put(None)
+
+    reader = threading.Thread(target=produce, name='reader', daemon=True)
+    reader.start()
+    try:
+        while True:
+            smp = samples.get()
+            if smp is None:
+                return
+            stage_release('read')
+            yield smp
+    finally:
+        stop.set()
+
+
+def start_workers():
+    ''' Start the upload worker pool (if requested)
+        Keyword arguments:
+          None
+        Returns:
+          None
+    '''
+    global CONVERTER, EXECUTOR, JACS_EXECUTOR # pylint: disable=W0603
+    if ARG.WRITE and ARG.JACS_WORKERS:
+        LOGGER.info("Starting %d JACS update workers", ARG.JACS_WORKERS)
+        JACS_EXECUTOR = ThreadPoolExecutor(max_workers=ARG.JACS_WORKERS,
+                                           thread_name_prefix='jacs')
+        add_stage('jacs', ARG.JACS_WORKERS)
+    if ARG.PROCESSES != 1:
+        processes = ARG.PROCESSES if ARG.PROCESSES > 1 else os.cpu_count()
+        LOGGER.info("Starting %d image conversion processes", processes)
+        add_stage('convert', processes)
+        # Don't fork a process that has running upload threads
+        CONVERTER = ProcessPoolExecutor(max_workers=processes,
+                                        mp_context=multiprocessing.get_context('spawn'))
+    if (ARG.WORKERS <= 1 and not CONVERTER) or not (ARG.AWS and ARG.WRITE):
+        return
+    workers = max(ARG.WORKERS, 1)
+    LOGGER.info("Starting %d upload workers", workers)
+    add_stage('upload', workers)
+    EXECUTOR = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='upload')
+
+
+def stop_workers():
+    ''' Wait for queued uploads to finish and shut down the worker pool
+        Keyword arguments:
+          None
+        Returns:
+          None
+    '''
+    global CONVERTER, EXECUTOR, JACS_EXECUTOR # pylint: disable=W0603
+    if CONVERTER:
+        # Conversions queue their uploads, so they must finish first (in-memory
+        # renders are submitted by start_render, never by upload workers)
+        LOGGER.info("Waiting for queued image conversions to complete")
+        CONVERTER.shutdown(wait=True)
+        CONVERTER = None
+    if EXECUTOR:
+        # Uploads queue JACS updates
+        LOGGER.info("Waiting for queued uploads to complete")
+        EXECUTOR.shutdown(wait=True)
+        EXECUTOR = None
+    if JACS_EXECUTOR:
+        LOGGER.info("Waiting for queued JACS updates to complete")
+        JACS_EXECUTOR.shutdown(wait=True)
+        JACS_EXECUTOR = None
+
+
+def sage_cursor():
+    ''' Return a server-side (streaming) cursor for SAGE, connecting on first use
+        Keyword arguments:
+          None
+        Returns:
+          database cursor
+    '''
+    if 'sage' not in CONN:
+        (CONN['sage'], CURSOR['sage']) = db_connect(DB_CONFIG['sage']['prod'])
+    return CONN['sage'].cursor(MySQLdb.cursors.SSCursor)
+
+
+def cached_mapping(name, stmt, tables):
+    ''' Yield rows for a mapping query from the local mapping cache
+        Keyword arguments:
+          name: cached query name
+          stmt: SQL statement
+          tables: list of source tables
+        Returns:
+          row tuples (generator)
     '''
-    driver = dict()
-    LOGGER.info("Getting line/driver mapping")
     try:
-        CURSOR['sage'].execute("SELECT DISTINCT publishing_name,driver FROM image_data_mv " \
-                               + "WHERE publishing_name IS NOT NULL AND driver IS NOT NULL")
-        rows = CURSOR['sage'].fetchall()
+        yield from ML.cached_query(name, stmt, tables, sage_cursor, ARG.REFRESH_MAPPINGS)
     except MySQLdb.Error as err:
         sql_error(err)
-    for row in rows:
-        driver[row['publishing_name']] = row['driver'].replace("_Collection", "").replace("-", "_")
+    except ML.MappingCacheError as err:
+        LOGGER.critical(err)
+        terminate_program(-1)
+
+
+def pushdown_query(stmt, keys):
+    ''' Yield rows for a SAGE query restricted to a set of keys. The keys are
+        sent in batches of PUSHDOWN_BATCH.
+        Keyword arguments:
+          stmt: SQL statement, with %s where the IN list goes
+          keys: keys
+        Returns:
+          row tuples (generator)
+    '''
+    keys = sorted(keys)
+    try:
+        cursor = sage_cursor()
+        for idx in range(0, len(keys), PUSHDOWN_BATCH):
+            batch = keys[idx:idx + PUSHDOWN_BATCH]
+            cursor.execute(stmt % (','.join(['%s'] * len(batch))), batch)
+            yield from cursor.fetchall()
+    except MySQLdb.Error as err:
+        sql_error(err)
+
+
+def scan_json_keys(data):
+    ''' Return the publishing names and sample IDs used by a set of samples
+        Keyword arguments:
+          data: samples (list or generator)
+        Returns:
+          publishing name set and sample ID set
+    '''
+    names = set()
+    sids = set()
+    for smp in data:
+        if smp.get('publishedName'):
+            names.add(smp['publishedName'])
+        if smp.get('sampleRef'):
+            sids.add((smp['sampleRef'].split('#'))[-1])
+    LOGGER.info("Found %d publishing names and %d samples in JSON", len(names), len(sids))
+    return names, sids
+
+
+def get_line_mapping(names=None):
+    ''' Create a mapping of publishing names to drivers. Note that "GAL4-Collection"
+        is remapped to "GAL4". Driver names are interned, since there are only a few.
+        Keyword arguments:
+          names: publishing names to map (None for all)
+        Returns:
+          driver dictionary
+    '''
+    driver = dict()
+    LOGGER.info("Getting line/driver mapping")
+    if names is None:
+        rows = cached_mapping('sage_line_driver',
+                              "SELECT DISTINCT publishing_name,driver FROM image_data_mv " \
+                              + "WHERE publishing_name IS NOT NULL AND driver IS NOT NULL",
+                              ['image_data_mv'])
+    else:
+        rows = pushdown_query("SELECT DISTINCT publishing_name,driver FROM image_data_mv " \
+                              + "WHERE publishing_name IN (%s) AND driver IS NOT NULL", names)
+    for (publishing_name, drv) in rows:
+        driver[publishing_name] = sys.intern(drv.replace("_Collection", "").replace("-", "_"))
     return driver
 
 
-def get_image_mapping():
-    ''' Create a dictionary of published sample IDs
+def get_image_mapping(sids=None):
+    ''' Create a set of published sample IDs
         Keyword arguments:
-          None
+          sids: sample IDs to check (None for all)
         Returns:
-          sample ID dictionary
+          sample ID frozenset
     '''
     LOGGER.info("Getting image mapping")
-    published_ids = dict()
     stmt = "SELECT DISTINCT workstation_sample_id FROM image_data_mv WHERE " \
            + "to_publish='Y' AND alps_release IS NOT NULL"
-    try:
-        CURSOR['sage'].execute(stmt)
-        rows = CURSOR['sage'].fetchall()
-    except MySQLdb.Error as err:
-        sql_error(err)
-    for row in rows:
-        published_ids[row['workstation_sample_id']] = 1
-    return published_ids
+    if sids is None:
+        rows = cached_mapping('sage_published_samples', stmt, ['image_data_mv'])
+    else:
+        rows = pushdown_query(stmt + " AND workstation_sample_id IN (%s)", sids)
+    return frozenset(row[0] for row in rows)
 
 
 def convert_file(sourcepath, newname):
@@ -413,11 +1212,188 @@ def convert_file(sourcepath, newname):
     '''
     LOGGER.debug("Converting %s to %s", sourcepath, newname)
     newpath = CLOAD['temp_dir']+ newname
-    with Image.open(sourcepath) as image:
-        image.save(newpath, 'PNG')
+    queue_conversion(sourcepath, newpath, 'PNG')
     return newpath
 
 
+def render_outputs(sourcepath, outputs):
+    ''' Decode an image once and write each requested output from it.
+        This may be run in a conversion process.
+        Keyword arguments:
+          sourcepath: source filepath
+          outputs: list of (target, format, maximum size). The target is a filepath,
+                   a file object, or None to return the encoded bytes. A maximum size
+                   of 0 keeps the full size.
+        Returns:
+          List of targets (encoded bytes for None targets)
+          List of (stage, seconds, bytes) timings for MT.observe. The decode time is
+          added to the convert stage (or to the thumbnail stage for thumbnail-only jobs).
+    '''
+    results = list()
+    timings = list()
+    start = time()
+    with Image.open(sourcepath) as image:
+        image.load()
+        decode = time() - start
+        if all(output[2] for output in outputs):
+            decode_stage = 'thumbnail'
+        else:
+            decode_stage = 'convert'
+        for target, fmt, max_size in outputs:
+            start = time()
+            output = io.BytesIO() if target is None else target
+            if max_size:
+                derived = image.copy()
+                derived.thumbnail(calculate_size(image.size, max_size))
+                derived.save(output, fmt)
+            else:
+                image.save(output, fmt)
+            stage = 'thumbnail' if max_size else 'convert'
+            seconds = time() - start
+            if stage == decode_stage:
+                seconds += decode
+                decode = 0
+            nbytes = os.path.getsize(output) if isinstance(output, str) else output.tell()
+            timings.append((stage, seconds, nbytes))
+            results.append(output.getvalue() if target is None else target)
+    return results, timings
+
+
+def record_render(timings):
+    ''' Record the timings returned by render_outputs
+        Keyword arguments:
+          timings: list of (stage, seconds, bytes)
+        Returns:
+          None
+    '''
+    for stage, seconds, nbytes in timings:
+        MT.observe(stage, seconds, nbytes)
+
+
+def queue_conversion(sourcepath, newpath, fmt, max_size=0):
+    ''' Add an output to the render job for a source image. If the source is itself
+        an output of a pending job, the original source is used and, if that job
+        hasn't started, the output is added to it, so each source image is only
+        decoded once. Jobs are started by start_render.
+        Keyword arguments:
+          sourcepath: source filepath
+          newpath: output filepath
+          fmt: output format (PNG or JPEG)
+          max_size: maximum size of the longest side (0 for full size)
+        Returns:
+          None
+    '''
+    job = RENDERS.get(sourcepath)
+    if job:
+        sourcepath = job['source']
+    if not job or job['started']:
+        job = {'source': sourcepath, 'outputs': dict(), 'started': False, 'future': None,
+               'memory': ARG.IN_MEMORY and ARG.AWS and ARG.WRITE,
+               'bodies': None, 'lock': threading.Lock()}
+    job['outputs'][newpath] = (fmt, max_size)
+    RENDERS[newpath] = job
+
+
+def start_render(newpath):
+    ''' Start the render job that produces a file, either immediately or in the
+        conversion process pool. In-memory jobs are submitted to the pool here too
+        (so upload workers never submit to it), but their outputs are taken by the
+        upload worker (see take_rendered); without a pool, they're rendered by the
+        upload worker.
+        Keyword arguments:
+          newpath: output filepath
+        Returns:
+          Future for a queued job that writes files, otherwise None
+    '''
+    job = RENDERS.get(newpath)
+    if not job or (job['memory'] and not CONVERTER):
+        return None
+    if job['started']:
+        return None if job['memory'] else job['future']
+    job['started'] = True
+    if job['memory']:
+        stage_acquire('convert')
+        job['future'] = CONVERTER.submit(render_outputs, job['source'],
+                                         [(None,) + job['outputs'][opath]
+                                          for opath in job['outputs']])
+        job['future'].add_done_callback(lambda _: stage_release('convert'))
+        return None
+    outputs = [(opath,) + job['outputs'][opath] for opath in job['outputs']]
+
+    def done(future):
+        for opath in job['outputs']:
+            if RENDERS.get(opath) is job:
+                del RENDERS[opath]
+        if CONVERTER:
+            stage_release('convert')
+            if not future.exception():
+                record_render(future.result()[1])
+
+    if not CONVERTER:
+        record_render(render_outputs(job['source'], outputs)[1])
+        done(None)
+        return None
+    stage_acquire('convert')
+    job['future'] = CONVERTER.submit(render_outputs, job['source'], outputs)
+    job['future'].add_done_callback(done)
+    return job['future']
+
+
+def take_rendered(job, newpath):
+    ''' Return one output of an in-memory render job. All of the job's outputs are
+        rendered (or, with a conversion pool, collected from the job's future) the
+        first time one is needed; each is kept in memory unless it is larger than
+        SPOOL_SIZE, in which case it's spooled to a temp file.
+        This may be run from an upload worker.
+        Keyword arguments:
+          job: render job
+          newpath: output filepath
+        Returns:
+          File object positioned at the start of the image
+    '''
+    with job['lock']:
+        if job['bodies'] is None:
+            opaths = list(job['outputs'])
+            bodies = [tempfile.SpooledTemporaryFile(max_size=SPOOL_SIZE) for _ in opaths]
+            if job.get('future'):
+                encoded, timings = job['future'].result()
+                for body, data in zip(bodies, encoded):
+                    body.write(data)
+            else:
+                timings = render_outputs(job['source'],
+                                         [(body,) + job['outputs'][opath]
+                                          for body, opath in zip(bodies, opaths)])[1]
+            record_render(timings)
+            job['bodies'] = dict(zip(opaths, bodies))
+        body = job['bodies'].pop(newpath)
+    body.seek(0)
+    return body
+
+
+def release_render(newpath):
+    ''' Drop an output that won't be started (or is rendered in memory) from the
+        pending render jobs
+        Keyword arguments:
+          newpath: output filepath
+        Returns:
+          None
+    '''
+    job = RENDERS.get(newpath)
+    if job and (job['memory'] or not job['started']):
+        del RENDERS[newpath]
+
+
+def flyem_name(bodyid, alignment_space):
+    ''' Return the primary image file name for a FlyEM body
+        Keyword arguments:
+          bodyid: body ID (publishing name)
+          alignment_space: alignment space
+        Returns:
+          New file name
+    '''
+    return '%s-%s-CDM.png' % (bodyid, alignment_space)
+
+
 def process_flyem(smp, convert=True):
     ''' Return the file name for a FlyEM sample.
         Keyword arguments:
@@ -432,8 +1408,7 @@ def process_flyem(smp, convert=True):
     #status = field[1]
     #if bodyid.endswith('-'):
     #    return False
-    newname = '%s-%s-CDM.png' \
-    % (bodyid, REC['alignment_space'])
+    newname = flyem_name(bodyid, REC['alignment_space'])
     if convert:
         smp['filepath'] = convert_file(smp['filepath'], newname)
     else:
@@ -464,15 +1439,14 @@ def get_smp_info(smp, published_ids):
     ''' Return the sample ID and publishing name
         Keyword arguments:
           smp: sample record
-          published_ids: sample dictionary
+          published_ids: published sample ID set
         Returns:
           Sample ID and publishing name, or None if error
     '''
     if 'sampleRef' not in smp or not smp['sampleRef']:
         COUNT['No sampleRef'] += 1
         err_text = "No sampleRef for %s (%s)" % (smp['_id'], smp['name'])
-        LOGGER.warning(err_text)
-        ERR.write(err_text + "\n")
+        log_error(err_text)
         return None, None
     sid = (smp['sampleRef'].split('#'))[-1]
     LOGGER.debug(sid)
@@ -480,21 +1454,18 @@ def get_smp_info(smp, published_ids):
         if sid not in published_ids:
             COUNT['Not published'] += 1
             err_text = "Sample %s was not published" % (sid)
-            LOGGER.error(err_text)
-            ERR.write(err_text + "\n")
+            log_error(err_text)
             return None, None
     if 'publishedName' not in smp or not smp['publishedName']:
         COUNT['No publishing name'] += 1
         err_text = "No publishing name for sample %s" % (sid)
-        LOGGER.error(err_text)
-        ERR.write(err_text + "\n")
+        log_error(err_text)
         return None, None
     publishing_name = smp['publishedName']
     if publishing_name == 'No Consensus':
         COUNT['No Consensus'] += 1
         err_text = "No consensus line for sample %s (%s)" % (sid, publishing_name)
-        LOGGER.error(err_text)
-        ERR.write(err_text + "\n")
+        log_error(err_text)
         if ARG.WRITE:
             return False
     if publishing_name not in PNAME:
@@ -509,7 +1480,7 @@ def process_light(smp, driver, published_ids):
         Keyword arguments:
           smp: sample record
           driver: driver mapping dictionary
-          published_ids: sample dictionary
+          published_ids: published sample ID set
         Returns:
           New file name
     '''
@@ -526,65 +1497,83 @@ def process_light(smp, driver, published_ids):
         if drv not in CLOAD['drivers']:
             COUNT['Bad driver'] += 1
             err_text = "Bad driver for sample %s (%s)" % (sid, publishing_name)
-            LOGGER.error(err_text)
-            ERR.write(err_text + "\n")
+            log_error(err_text)
             if ARG.WRITE:
                 terminate_program(-1)
             return False
     else:
         COUNT['No driver'] += 1
         err_text = "No driver for sample %s (%s)" % (sid, publishing_name)
-        LOGGER.error(err_text)
-        ERR.write(err_text + "\n")
+        log_error(err_text)
         if ARG.WRITE:
             terminate_program(-1)
         return False
     fname = os.path.basename(smp['filepath'])
+    chan = get_channel(fname)
+    if chan not in ['1', '2', '3', '4']:
+        LOGGER.critical("Could not find channel for %s (%s)", fname, chan)
+        terminate_program(-1)
+    return light_name(REC, drv, chan)
+
+
+def get_channel(fname):
+    ''' Return the channel of a light microscopy CDM file
+        Keyword arguments:
+          fname: file name
+        Returns:
+          channel
+    '''
     if 'gamma' in fname:
         chan = fname.split('-')[-2]
     else:
         chan = fname.split('-')[-1]
-    chan = chan.split('_')[0].replace('CH', '')
-    if chan not in ['1', '2', '3', '4']:
-        LOGGER.critical("Could not find channel for %s (%s)", fname, chan)
-        terminate_program(-1)
-    newname = '%s-%s-%s-%s-%s-%s-%s-CDM_%s.png' \
-        % (REC['line'], REC['slide_code'], drv, REC['gender'],
-           REC['objective'], REC['area'], REC['alignment_space'], chan)
-    return newname
+    return chan.split('_')[0].replace('CH', '')
+
+
+def light_name(rec, drv, chan):
+    ''' Return the primary image file name for a light microscopy sample
+        Keyword arguments:
+          rec: line, slide_code, gender, objective, area, and alignment_space
+          drv: driver
+          chan: channel
+        Returns:
+          New file name
+    '''
+    return '%s-%s-%s-%s-%s-%s-%s-CDM_%s.png' \
+        % (rec['line'], rec['slide_code'], drv, rec['gender'],
+           rec['objective'], rec['area'], rec['alignment_space'], chan)
 
 
-def calculate_size(dim):
-    ''' Return the fnew dimensions for an image. The longest side will be scaled down to MAX_SIZE.
+def calculate_size(dim, max_size=MAX_SIZE):
+    ''' Return the fnew dimensions for an image. The longest side will be scaled down to max_size.
         Keyword arguments:
           dim: tuple with (X,Y) dimensions
+          max_size: maximum size of the longest side
         Returns:
           Tuple with new (X,Y) dimensions
     '''
     xdim, ydim = list(dim)
-    if xdim <= MAX_SIZE and ydim <= MAX_SIZE:
+    if xdim <= max_size and ydim <= max_size:
         return dim
     if xdim > ydim:
-        ratio = xdim / MAX_SIZE
-        xdim, ydim = [MAX_SIZE, int(ydim/ratio)]
+        ratio = xdim / max_size
+        xdim, ydim = [max_size, int(ydim/ratio)]
     else:
-        ratio = ydim / MAX_SIZE
-        xdim, ydim = [int(xdim/ratio), MAX_SIZE]
+        ratio = ydim / max_size
+        xdim, ydim = [int(xdim/ratio), max_size]
     return tuple((xdim, ydim))
 
 
 def resize_image(image_path, resized_path):
-    ''' Read in an image, resize it, and write a copy.
+    ''' Queue a resized copy of an image. It is written when the image's render job
+        is started.
         Keyword arguments:
           image_path: CDM image path
           resized_path: path for resized image
         Returns:
           None
     '''
-    with Image.open(image_path) as image:
-        new_size = calculate_size(image.size)
-        image.thumbnail(new_size)
-        image.save(resized_path, 'JPEG')
+    queue_conversion(image_path, resized_path, 'JPEG', MAX_SIZE)
 
 
 def produce_thumbnail(dirpath, fname, newname, url):
@@ -598,10 +1587,9 @@ def produce_thumbnail(dirpath, fname, newname, url):
     turl = url.replace('.png', '.jpg')
     turl = turl.replace(AWS['s3_bucket']['cdm'], AWS['s3_bucket']['cdm-thumbnail'])
     if CREATE_THUMBNAIL:
+        # The thumbnail was queued by upload_primary
         tname = newname.replace('.png', '.jpg')
-        complete_fpath = '/'.join([dirpath, fname])
-        resize_image(complete_fpath, '/tmp/' + tname)
-        turl = upload_aws(AWS['s3_bucket']['cdm-thumbnail'], '/tmp', tname, tname)
+        turl = upload_aws(AWS['s3_bucket']['cdm-thumbnail'], '/tmp', tname, tname, track=True)
     return turl
 
 
@@ -617,9 +1605,42 @@ def update_jacs(sid, url, turl):
     pay = {"class": "org.janelia.model.domain.gui.cdmip.ColorDepthImage",
            "publicImageUrl": url,
            "publicThumbnailUrl": turl}
+    if not JACS_EXECUTOR:
+        put_jacs(sid, pay)
+        return
+    stage_acquire('jacs')
+    future = JACS_EXECUTOR.submit(put_jacs, sid, pay)
+    future.add_done_callback(check_jacs)
+
+
+def put_jacs(sid, pay):
+    ''' Send a sample's public URLs to JACS. This may be run from a JACS worker.
+        Keyword arguments:
+          sid: sample ID
+          pay: payload
+        Returns:
+          None
+    '''
+    start = time()
     call_responder('jacsv2', 'colorDepthMIPs/' + sid \
                    + '/publicURLs', pay, True)
-    COUNT['Updated on JACS'] += 1
+    MT.observe('jacs_put', time() - start)
+    increment_counter(COUNT, 'Updated on JACS')
+    journal_record('JACS', sid)
+
+
+def check_jacs(future):
+    ''' Stop processing if a queued JACS update failed
+        Keyword arguments:
+          future: JACS update future
+        Returns:
+          None
+    '''
+    stage_release('jacs')
+    err = future.exception()
+    if err and not isinstance(err, SystemExit):
+        log_error("JACS update failed: %s" % (str(err)))
+        ABORT.set()
 
 
 def set_name_and_filepath(smp):
@@ -657,12 +1678,11 @@ def upload_flyem_variants(smp, newname):
         dirpath = os.path.dirname(smp['variants'][variant])
         fname = os.path.basename(smp['variants'][variant])
         if variant == 'searchable_neurons':
-            if SUBDIVISION['counter'] >= SUBDIVISION['limit']:
-                SUBDIVISION['prefix'] += 1
-                SUBDIVISION['counter'] = 0
+            prefix = get_subdivision(smp)
+            if not prefix:
+                continue
             ancname = ancname.replace('searchable_neurons/',
-                                      'searchable_neurons/%s/' % str(SUBDIVISION['prefix']))
-            SUBDIVISION['counter'] += 1
+                                      'searchable_neurons/%s/' % prefix)
         _ = upload_aws(AWS['s3_bucket']['cdm'], dirpath, fname, ancname)
         if variant not in VARIANT_UPLOADS:
             VARIANT_UPLOADS[variant] = 1
@@ -670,6 +1690,17 @@ def upload_flyem_variants(smp, newname):
             VARIANT_UPLOADS[variant] += 1
 
 
+def get_sequence(fname):
+    ''' Find the sequence number in a light microscopy variant file name
+        Keyword arguments:
+          fname: file name (without extension)
+        Returns:
+          match object (sequence number in group 1), or None
+    '''
+    # MB002B-20121003_31_B2-f_20x_c1_01
+    return re.search(r"-CH\d+-(\d+)", fname)
+
+
 def upload_flylight_variants(smp, newname):
     ''' Upload variant files for FlyLight
         Keyword arguments:
@@ -693,8 +1724,7 @@ def upload_flylight_variants(smp, newname):
             COUNT['Unparsable files'] += 1
             continue
         fname, ext = os.path.basename(smp['variants'][variant]).split('.')
-        # MB002B-20121003_31_B2-f_20x_c1_01
-        seqsearch = re.search(r"-CH\d+-(\d+)", fname)
+        seqsearch = get_sequence(fname)
         if seqsearch is None:
             LOGGER.error("Could not extract sequence number from %s file %s", variant, fname)
             COUNT['Unparsable files'] += 1
@@ -707,12 +1737,11 @@ def upload_flylight_variants(smp, newname):
         #print(fname)
         #print(ancname)
         if variant == 'searchable_neurons':
-            if SUBDIVISION['counter'] >= SUBDIVISION['limit']:
-                SUBDIVISION['prefix'] += 1
-                SUBDIVISION['counter'] = 0
+            prefix = get_subdivision(smp)
+            if not prefix:
+                continue
             ancname = ancname.replace('searchable_neurons/',
-                                      'searchable_neurons/%s/' % str(SUBDIVISION['prefix']))
-            SUBDIVISION['counter'] += 1
+                                      'searchable_neurons/%s/' % prefix)
         _ = upload_aws(AWS['s3_bucket']['cdm'], dirpath, fname, ancname)
         if variant not in VARIANT_UPLOADS:
             VARIANT_UPLOADS[variant] = 1
@@ -733,7 +1762,7 @@ def check_image(smp):
         terminate_program(-1)
     LOGGER.debug('----- %s', smp['imageName'])
     if 'publicImageUrl' in smp and smp['publicImageUrl'] and not ARG.REWRITE:
-        COUNT['Already on JACS'] += 1
+        increment_counter(COUNT, 'Already on JACS')
         return False
     return True
 
@@ -748,18 +1777,46 @@ def upload_primary(smp, newname):
     '''
     dirpath = os.path.dirname(smp['filepath'])
     fname = os.path.basename(smp['filepath'])
-    url = upload_aws(AWS['s3_bucket']['cdm'], dirpath, fname, newname)
+    tpath = '/tmp/' + newname.replace('.png', '.jpg')
+    if CREATE_THUMBNAIL:
+        # Queue the thumbnail before the primary upload starts the render job,
+        # so both are produced from a single decode of the source image
+        resize_image(smp['filepath'], tpath)
+    url = upload_aws(AWS['s3_bucket']['cdm'], dirpath, fname, newname, track=True)
     if url:
         if url != 'Skipped':
             turl = produce_thumbnail(dirpath, fname, newname, url)
             if ARG.WRITE:
-                if ARG.AWS and ('flyem_' in ARG.LIBRARY):
-                    os.remove(smp['filepath'])
-                update_jacs(smp['_id'], url, turl)
+                after_upload([url, turl], finish_primary, smp, url, turl)
             else:
                 LOGGER.info("Primary %s", url)
     elif ARG.WRITE:
         LOGGER.error("Did not transfer primary image %s", fname)
+    release_render(smp['filepath'])
+    release_render(tpath)
+
+
+def finish_primary(success, smp, url, turl):
+    ''' Clean up and update JACS once the primary image has been uploaded
+        Keyword arguments:
+          success: True if the primary (and thumbnail) upload succeeded
+          smp: sample record
+          url: image URL
+          turl: thumbnail URL
+        Returns:
+          None
+    '''
+    if not success:
+        log_error("Did not transfer primary image %s" % (os.path.basename(smp['filepath'])))
+        return
+    # The converted file isn't rendered if the upload was skipped (--check/--resume)
+    if ARG.AWS and ('flyem_' in ARG.LIBRARY) and not ARG.IN_MEMORY \
+       and os.path.exists(smp['filepath']):
+        os.remove(smp['filepath'])
+    if smp['_id'] in JOURNAL['JACS']:
+        increment_counter(COUNT, 'Already on JACS')
+        return
+    update_jacs(smp['_id'], url, turl)
 
 
 def handle_primary(smp, driver, published_ids):
@@ -767,10 +1824,11 @@ def handle_primary(smp, driver, published_ids):
         Keyword arguments:
           smp: sample record
           driver: driver mapping dictionary
-          published_ids: sample dictionary
+          published_ids: published sample ID set
         Returns:
           New file name
     '''
+    start = time()
     skip_primary = False
     newname = None
     if 'flyem_' in ARG.LIBRARY:
@@ -782,8 +1840,7 @@ def handle_primary(smp, driver, published_ids):
             newname = process_flyem(smp)
             if not newname:
                 err_text = "No publishing name for FlyEM %s" % smp['name']
-                LOGGER.error(err_text)
-                ERR.write(err_text + "\n")
+                log_error(err_text)
                 COUNT['No publishing name'] += 1
                 return None
     else:
@@ -794,11 +1851,11 @@ def handle_primary(smp, driver, published_ids):
         newname = process_light(smp, driver, published_ids)
         if not newname:
             err_text = "No publishing name for FlyLight %s" % smp['name']
-            LOGGER.error(err_text)
-            ERR.write(err_text + "\n")
+            log_error(err_text)
             return None
         if 'imageArchivePath' in smp and 'imageName' in smp:
             smp['searchableNeuronsName'] = '/'.join([smp['imageArchivePath'], smp['imageName']])
+    MT.observe('metadata', time() - start)
     if not skip_primary:
         upload_primary(smp, newname)
     return newname
@@ -830,6 +1887,52 @@ def handle_variants(smp, newname):
         upload_flylight_variants(smp, newname)
 
 
+def read_json_samples(json_path, chunk_size=1024 * 1024):
+    ''' Incrementally parse a JSON file containing a top-level array, yielding one
+        element at a time. Only a small read buffer is kept in memory.
+        Keyword arguments:
+          json_path: path to JSON file
+          chunk_size: number of characters to read at a time
+        Returns:
+          Generator of samples
+    '''
+    decoder = json.JSONDecoder()
+    separator = re.compile(r'[\s,]*')
+    with open(json_path, 'r') as jfile:
+        buf = jfile.read(chunk_size).lstrip()
+        if not buf.startswith('['):
+            LOGGER.critical("%s does not contain a JSON array", json_path)
+            terminate_program(-1)
+        pos = 1
+        while True:
+            pos = separator.match(buf, pos).end()
+            if pos >= len(buf):
+                more = jfile.read(chunk_size)
+                if not more:
+                    LOGGER.critical("Unexpected end of file in %s", json_path)
+                    terminate_program(-1)
+                buf = buf[pos:] + more
+                pos = 0
+                continue
+            if buf[pos] == ']':
+                return
+            try:
+                smp, end = decoder.raw_decode(buf, pos)
+            except json.JSONDecodeError as err:
+                more = jfile.read(chunk_size)
+                if not more:
+                    LOGGER.critical("Could not parse %s: %s", json_path, err)
+                    terminate_program(-1)
+                buf = buf[pos:] + more
+                pos = 0
+                continue
+            yield smp
+            pos = end
+            if pos >= chunk_size:
+                buf = buf[pos:]
+                pos = 0
+
+
 def upload_cdms_from_file():
     ''' Upload color depth MIPs and other files to AWS S3.
         The list of color depth MIPs comes from a supplied JSON file.
@@ -838,18 +1941,59 @@ def upload_cdms_from_file():
         Returns:
           None
     '''
-    if 'flyem_' not in ARG.LIBRARY:
+    if ARG.STREAM:
+        data = read_ahead(read_json_samples(ARG.JSON))
+    else:
+        jfile = open(ARG.JSON, 'r')
+        data = json.load(jfile)
+        jfile.close()
+        entries = len(data)
+        print("Number of entries in JSON: %d" % entries)
+    if 'flyem_' in ARG.LIBRARY:
+        driver = {}
+        published_ids = frozenset()
+    elif ARG.PUSHDOWN:
+        names, sids = scan_json_keys(read_json_samples(ARG.JSON) if ARG.STREAM else data)
+        driver = get_line_mapping(names)
+        published_ids = get_image_mapping(sids)
+    else:
         driver = get_line_mapping()
         published_ids = get_image_mapping()
+    if 'searchable_neurons' in WILL_LOAD:
+        if ARG.STREAM and not ARG.PLAN_PASS \
+           and not (ARG.SUBDIVISION_PLAN and os.path.isfile(ARG.SUBDIVISION_PLAN)):
+            LOGGER.critical("--stream requires an existing --subdivision-plan file (or "
+                            + "--plan-pass to read the JSON file an extra time to plan it)")
+            terminate_program(-1)
+        load_subdivisions(read_json_samples(ARG.JSON) if ARG.STREAM else data)
+    if ARG.DASK_SCHEDULER:
+        process_on_dask(data, driver, published_ids)
     else:
-        driver = {}
-        published_ids = {}
-    jfile = open(ARG.JSON, 'r')
-    data = json.load(jfile)
-    jfile.close()
-    entries = len(data)
-    print("Number of entries in JSON: %d" % entries)
-    for smp in tqdm(data):
+        process_samples(data, driver, published_ids)
+    if ABORT.is_set():
+        terminate_program(-1)
+
+
+def process_samples(data, driver, published_ids, show_progress=True):
+    ''' Upload the images for a set of samples
+        Keyword arguments:
+          data: samples (list or generator)
+          driver: driver mapping dictionary
+          published_ids: published sample ID set
+          show_progress: show a progress bar
+        Returns:
+          None
+    '''
+    start_workers()
+    progress = tqdm(data) if show_progress else data
+    shown = 0
+    for smp in progress:
+        if show_progress and STAGES and time() - shown >= 1:
+            progress.set_postfix_str(stage_status(), refresh=False)
+            shown = time()
+        if ABORT.is_set():
+            stop_workers()
+            terminate_program(-1)
         smp['_id'] = smp['id']
         if ARG.SAMPLES and COUNT['Samples'] >= ARG.SAMPLES:
             break
@@ -862,6 +2006,297 @@ def upload_cdms_from_file():
         # Variants
         if newname:
             handle_variants(smp, newname)
+    stop_workers()
+
+
+def sample_objects(smp, driver, published_ids):
+    ''' Work out the objects that will be uploaded for a sample, without logging,
+        counting, or converting anything (see claim_chunk)
+        Keyword arguments:
+          smp: sample record
+          driver: driver mapping dictionary
+          published_ids: published sample ID set
+        Returns:
+          list of (S3 object name, source file path)
+    '''
+    if 'imageName' not in smp or not smp.get('publishedName') \
+       or (smp.get('publicImageUrl') and not ARG.REWRITE):
+        return []
+    REC['alignment_space'] = smp['alignmentSpace']
+    variants = dict(smp.get('variants') or {})
+    files = list()
+    if 'flyem_' in ARG.LIBRARY:
+        newname = flyem_name(smp['publishedName'], smp['alignmentSpace'])
+        if '_FL' in smp['imageName']:
+            fbase = newname.replace('CDM.', 'CDM-FL.').split('.')[0]
+            newname = None
+        else:
+            fbase = newname.split('.')[0]
+            filepath = CLOAD['temp_dir'] + newname
+    else:
+        filepath = variants.pop(ARG.GAMMA, smp['cdmPath'])
+        sid = (smp.get('sampleRef') or '').split('#')[-1]
+        drv = driver.get(smp['publishedName'])
+        chan = get_channel(os.path.basename(filepath))
+        if not sid or smp['publishedName'] == 'No Consensus' or drv not in CLOAD['drivers'] \
+           or chan not in ['1', '2', '3', '4'] \
+           or (ARG.LIBRARY in ['flylight_splitgal4_drivers'] and sid not in published_ids):
+            return []
+        rec = {'line': smp['publishedName'], 'slide_code': smp['slideCode'],
+               'gender': smp['gender'], 'objective': smp['objective'],
+               'area': smp['anatomicalArea'].lower(), 'alignment_space': smp['alignmentSpace']}
+        newname = light_name(rec, drv, chan)
+        fbase = newname.split('.')[0]
+    if newname:
+        files.append((AWS['s3_bucket']['cdm'], filepath, newname))
+        if CREATE_THUMBNAIL:
+            tname = newname.replace('.png', '.jpg')
+            files.append((AWS['s3_bucket']['cdm-thumbnail'], '/tmp/' + tname, tname))
+    for variant, vpath in variants.items():
+        fname = os.path.basename(vpath).split('.')
+        if variant not in WILL_LOAD or len(fname) != 2:
+            continue
+        if 'flyem_' in ARG.LIBRARY:
+            ancname = '%s/%s.%s' % (variant, fbase, fname[1])
+        else:
+            seqsearch = get_sequence(fname[0])
+            if seqsearch is None:
+                continue
+            ancname = '%s/%s-%s.%s' % (variant, fbase, seqsearch[1], fname[1])
+        if variant == 'searchable_neurons':
+            prefix = SUBDIVISION['prefix'].get(vpath)
+            if not prefix:
+                continue
+            ancname = ancname.replace('searchable_neurons/', 'searchable_neurons/%s/' % prefix)
+        files.append((AWS['s3_bucket']['cdm'], vpath, ancname))
+    return [(get_s3_names(bucket, newname)[1],
+             '/'.join([os.path.dirname(fpath), os.path.basename(fpath)]))
+            for bucket, fpath, newname in files]
+
+
+def claim_chunk(samples, driver, published_ids):
+    ''' Claim the objects a chunk of samples will upload with a single call to the
+        UploadCoordinator, so uploads don't each wait on the actor. Objects that
+        can't be worked out in advance are claimed as they're uploaded.
+        Keyword arguments:
+          samples: list of samples
+          driver: driver mapping dictionary
+          published_ids: published sample ID set
+        Returns:
+          list of (S3 object name, source file path) claimed
+    '''
+    objects = list()
+    for smp in samples:
+        try:
+            objects.extend(sample_objects(smp, driver, published_ids))
+        except (KeyError, AttributeError):
+            continue
+    CLAIMED.update({object_name: None for object_name, _ in objects})
+    CLAIMED.update(COORDINATOR.claim_batch(objects).result())
+    return [obj for obj in objects if CLAIMED[obj[0]] is None]
+
+
+def release_chunk(claimed):
+    ''' Release the objects claimed by claim_chunk that the chunk didn't upload
+        (e.g. samples that were skipped, or everything after an abort), so other
+        chunks don't treat them as duplicates
+        Keyword arguments:
+          claimed: list of (S3 object name, source file path) from claim_chunk
+        Returns:
+          None
+    '''
+    unused = [obj for obj in claimed if obj[0] not in UPLOADED_NAME]
+    if unused:
+        LOGGER.debug("Releasing %d unused object claims", len(unused))
+        COORDINATOR.release(unused).result()
+
+
+def daemonic_worker():
+    ''' Check if this is a daemonic process (Dask worker processes are by default,
+        and can't start the --processes conversion pool)
+        Keyword arguments:
+          None
+        Returns:
+          True if the process is daemonic
+    '''
+    return multiprocessing.current_process().daemon
+
+
+def process_chunk(state, samples, coordinator, mappings, journal):
+    ''' Process a chunk of samples on a Dask worker. Chunks share this module's
+        state, so each worker process runs one chunk at a time (the chunk itself
+        uses the --workers/--processes/--jacs-workers pools).
+        Keyword arguments:
+          state: settings and configuration (see process_on_dask)
+          samples: list of samples
+          coordinator: UploadCoordinator actor
+          mappings: (driver mapping dictionary, published sample ID set,
+                     searchable_neurons subdivisions)
+          journal: S3 uploads and JACS updates completed in a previous run
+        Returns:
+          chunk results (counters, keys, error/s3cp/journal text, metrics)
+    '''
+    global ARG, AWS, CLOAD, CONFIG, COORDINATOR, ERR, LIBRARY, LOGGER, S3CP, TAGS, \
+           WILL_LOAD # pylint: disable=W0603
+    with LOCK['chunk']:
+        ARG = state['arg']
+        AWS, CLOAD, CONFIG, LIBRARY = state['aws'], state['cload'], state['config'], \
+                                      state['library']
+        TAGS, WILL_LOAD = state['tags'], state['will_load']
+        COORDINATOR = coordinator
+        if 'LOGGER' not in globals():
+            LOGGER = colorlog.getLogger()
+        os.environ['JACS_JWT'] = state['token']
+        RL.configure(**state['responder'])
+        for key in COUNT:
+            COUNT[key] = 0
+        for chunk_state in (VARIANT_UPLOADS, TRANSACTIONS, PNAME, KEY_LIST, UPLOADED_NAME,
+                            CLAIMED, PENDING, RENDERS, STAGES):
+            chunk_state.clear()
+        ABORT.clear()
+        MT.export(reset=True)
+        SUBDIVISION['prefix'] = mappings[2]
+        JOURNAL['S3'], JOURNAL['JACS'] = journal['S3'], journal['JACS']
+        JOURNAL['file'], JOURNAL['handle'] = '', io.StringIO()
+        ERR, S3CP = io.StringIO(), io.StringIO()
+        if not S3_CLIENT:
+            initialize_s3()
+        claimed = list()
+        try:
+            claimed = claim_chunk(samples, mappings[0], mappings[1])
+            process_samples(samples, mappings[0], mappings[1], False)
+        except SystemExit:
+            ABORT.set()
+            stop_workers()
+        finally:
+            release_chunk(claimed)
+        with LOCK['journal']:
+            journal_text = JOURNAL['handle'].getvalue()
+            JOURNAL['handle'] = None
+        return {'count': dict(COUNT), 'variants': dict(VARIANT_UPLOADS),
+                'transactions': dict(TRANSACTIONS), 'keys': list(KEY_LIST),
+                'errors': ERR.getvalue(), 's3cp': S3CP.getvalue(), 'journal': journal_text,
+                'metrics': MT.export(reset=True), 'samples': len(samples),
+                'aborted': ABORT.is_set()}
+
+
+def merge_chunk(result):
+    ''' Add the results of a chunk processed on a Dask worker to this run's
+        counters and files
+        Keyword arguments:
+          result: chunk results (from process_chunk)
+        Returns:
+          None
+    '''
+    for counter, key in ((COUNT, 'count'), (VARIANT_UPLOADS, 'variants'),
+                         (TRANSACTIONS, 'transactions')):
+        for name, value in result[key].items():
+            increment_counter(counter, name, value)
+    KEY_LIST.extend(result['keys'])
+    with LOCK['error']:
+        ERR.write(result['errors'])
+    with LOCK['s3cp']:
+        S3CP.write(result['s3cp'])
+    with LOCK['journal']:
+        if JOURNAL['handle'] and result['journal']:
+            JOURNAL['handle'].write(result['journal'])
+            sync_journal()
+    MT.merge(result['metrics'])
+    if result['aborted']:
+        ABORT.set()
+
+
+def chunk_samples(data):
+    ''' Split samples into chunks of ARG.DASK_CHUNK, stopping after ARG.SAMPLES
+        Keyword arguments:
+          data: samples (list or generator)
+        Returns:
+          Generator of sample lists
+    '''
+    chunk = list()
+    total = 0
+    for smp in data:
+        if ARG.SAMPLES and total >= ARG.SAMPLES:
+            break
+        chunk.append(smp)
+        total += 1
+        if len(chunk) >= ARG.DASK_CHUNK:
+            yield chunk
+            chunk = list()
+    if chunk:
+        yield chunk
+
+
+def process_on_dask(data, driver, published_ids):
+    ''' Process samples in chunks on a Dask cluster. Workers must be able to read
+        the source files and reach S3 and JACS. Object names are claimed through an
+        UploadCoordinator actor (one call per chunk, see claim_chunk), so they are
+        consistent across chunks, and the searchable_neurons subdivision plan is sent
+        to every worker; counters, keys, and error/s3cp/journal entries are merged
+        here as chunks complete.
+        Keyword arguments:
+          data: samples (list or generator)
+          driver: driver mapping dictionary
+          published_ids: published sample ID set
+        Returns:
+          None
+    '''
+    try:
+        from dask.distributed import Client, as_completed # pylint: disable=C0415
+    except ImportError:
+        LOGGER.critical("--dask-scheduler requires dask and distributed")
+        terminate_program(-1)
+    # Import this program as a module, so tasks are sent to workers by reference
+    import upload_cdms # pylint: disable=C0415,W0406
+    client = Client(ARG.DASK_SCHEDULER)
+    bindir = os.path.dirname(os.path.abspath(__file__))
+    for module in ['responder_lib', 'mapping_lib', 'metrics_lib', 'upload_cdms']:
+        client.upload_file(os.path.join(bindir, module + '.py'))
+    workers = len(client.scheduler_info()['workers'])
+    print("Processing on %d Dask workers at %s" % (workers, ARG.DASK_SCHEDULER))
+    if ARG.PROCESSES != 1 and any(client.run(upload_cdms.daemonic_worker).values()):
+        LOGGER.critical("--processes can't be used with daemonic Dask workers (set "
+                        + "distributed.worker.daemon: False in the workers' Dask configuration)")
+        client.close()
+        terminate_program(-1)
+    arg = copy.copy(ARG)
+    arg.SAMPLES = 0
+    arg.DASK_SCHEDULER = ''
+    state = {'arg': arg, 'aws': AWS, 'cload': CLOAD, 'config': CONFIG, 'library': LIBRARY,
+             'tags': TAGS, 'will_load': WILL_LOAD, 'token': os.environ['JACS_JWT'],
+             'responder': {key: RL.SETTINGS[key] for key in ('connect_timeout', 'read_timeout',
+                                                             'retries', 'pool_size')}}
+    coordinator = client.submit(upload_cdms.UploadCoordinator, actor=True).result()
+    mappings = client.scatter((driver, published_ids, SUBDIVISION['prefix']), broadcast=True)
+    journal = client.scatter({'S3': JOURNAL['S3'], 'JACS': JOURNAL['JACS']}, broadcast=True)
+    chunks = chunk_samples(data)
+    running = as_completed()
+    # Keep two chunks per worker queued, so the input is read as it's needed
+    for chunk in chunks:
+        running.add(client.submit(upload_cdms.process_chunk, state, chunk, coordinator,
+                                  mappings, journal, pure=False))
+        if running.count() >= 2 * max(workers, 1):
+            break
+    progress = tqdm(unit='sample')
+    for future in running:
+        try:
+            result = future.result()
+        except Exception as err: # pylint: disable=broad-except
+            log_error("Dask chunk failed: %s" % (str(err)))
+            ABORT.set()
+        else:
+            merge_chunk(result)
+            progress.update(result['samples'])
+        if ABORT.is_set():
+            for pending in running.futures:
+                pending.cancel()
+            break
+        chunk = next(chunks, None)
+        if chunk:
+            running.add(client.submit(upload_cdms.process_chunk, state, chunk, coordinator,
+                                      mappings, journal, pure=False))
+    progress.close()
+    client.close()
 
 
 def update_library_config():
@@ -884,12 +2319,18 @@ def update_library_config():
     LIBRARY[ARG.LIBRARY][ARG.MANIFOLD][ARG.JSON]['updated_by'] = FULL_NAME
     LIBRARY[ARG.LIBRARY][ARG.MANIFOLD][ARG.JSON]['method'] = 'JSON file'
     if ARG.WRITE or ARG.CONFIG:
-        resp = requests.post(CONFIG['config']['url'] + 'importjson/cdm_library/' + ARG.LIBRARY,
-                             {"config": json.dumps(LIBRARY[ARG.LIBRARY])})
+        try:
+            resp = RL.request('POST', CONFIG['config']['url'] + 'importjson/cdm_library/'
+                              + ARG.LIBRARY, 'config',
+                              data={"config": json.dumps(LIBRARY[ARG.LIBRARY])})
+        except RL.ResponderError as err:
+            LOGGER.error(err)
+            return
         if resp.status_code != 200:
             LOGGER.error(resp.json()['rest']['message'])
         else:
             LOGGER.info("Updated cdm_library configuration")
+            RL.invalidate(CONFIG['config']['url'] + 'config/cdm_library')
 
 
 if __name__ == '__main__':
@@ -908,12 +2349,39 @@ if __name__ == '__main__':
     PARSER.add_argument('--rewrite', dest='REWRITE', action='store_true',
                         default=False,
                         help='Flag, Update image in AWS and on JACS')
+    PARSER.add_argument('--changed', dest='CHANGED', action='store_true',
+                        default=False,
+                        help='Flag, Only upload files whose content differs from S3 ' \
+                             + '(with --aws --write; JACS is still updated, and unchanged ' \
+                             + 'files are left out of the s3cp order file). Files are ' \
+                             + 'hashed by the upload workers, or one at a time on the ' \
+                             + 'main thread with --workers 1 and no --processes')
     PARSER.add_argument('--aws', dest='AWS', action='store_true',
                         default=False, help='Write files to AWS')
     PARSER.add_argument('--config', dest='CONFIG', action='store_true',
                         default=False, help='Update configuration')
     PARSER.add_argument('--samples', dest='SAMPLES', action='store', type=int,
                         default=0, help='Number of samples to transfer')
+    PARSER.add_argument('--resume', dest='RESUME', action='store',
+                        default='',
+                        help='Journal file from a previous run to resume (use the same ' \
+                             + 'JSON file and image types)')
+    PARSER.add_argument('--stream', dest='STREAM', action='store_true',
+                        default=False,
+                        help='Flag, Parse the JSON file incrementally')
+    PARSER.add_argument('--batch-size', dest='BATCH_SIZE', action='store', type=int,
+                        default=100, help='searchable_neurons files per subdivision')
+    PARSER.add_argument('--subdivision-plan', dest='SUBDIVISION_PLAN', action='store',
+                        default='',
+                        help='searchable_neurons subdivision plan file (read if it ' \
+                             + 'exists, otherwise written). Required with --stream ' \
+                             + 'unless --plan-pass is set')
+    PARSER.add_argument('--plan-pass', dest='PLAN_PASS', action='store_true',
+                        default=False,
+                        help='Flag, With --stream, read the whole JSON file once before ' \
+                             + 'uploading to plan searchable_neurons subdivisions (delays ' \
+                             + 'the first upload, and keeps every searchable_neurons ' \
+                             + 'path in memory)')
     PARSER.add_argument('--version', dest='VERSION', action='store',
                         default='1.0', help='EM Version')
     PARSER.add_argument('--check', dest='CHECK', action='store_true',
@@ -921,6 +2389,49 @@ if __name__ == '__main__':
                         help='Flag, Check for previous AWS upload')
     PARSER.add_argument('--manifold', dest='MANIFOLD', action='store',
                         default='dev', help='S3 manifold')
+    PARSER.add_argument('--workers', dest='WORKERS', action='store', type=int,
+                        default=1, help='Number of concurrent S3 upload workers')
+    PARSER.add_argument('--queue-factor', dest='QUEUE_FACTOR', action='store', type=int,
+                        default=2,
+                        help='Items queued per worker before a stage blocks its producer')
+    PARSER.add_argument('--in-memory', dest='IN_MEMORY', action='store_true',
+                        default=False,
+                        help='Flag, Encode converted images and thumbnails in memory ' \
+                             + 'instead of temp files')
+    PARSER.add_argument('--jacs-workers', dest='JACS_WORKERS', action='store', type=int,
+                        default=4,
+                        help='Number of concurrent JACS updates (0 to update inline)')
+    PARSER.add_argument('--refresh-config', dest='REFRESH_CONFIG', action='store_true',
+                        default=False, help='Flag, Bypass the local configuration cache')
+    PARSER.add_argument('--pushdown', dest='PUSHDOWN', action='store_true',
+                        default=False,
+                        help='Flag, Only query SAGE for the publishing names and samples ' \
+                             + 'in the JSON file (bypasses the mapping cache)')
+    PARSER.add_argument('--refresh-mappings', dest='REFRESH_MAPPINGS', action='store_true',
+                        default=False,
+                        help='Flag, Query SAGE for line/image mappings instead of using ' \
+                             + 'the local mapping cache')
+    PARSER.add_argument('--timeout', dest='TIMEOUT', action='store', type=int,
+                        default=120, help='REST call read timeout (seconds)')
+    PARSER.add_argument('--retries', dest='RETRIES', action='store', type=int,
+                        default=5, help='Maximum retries for idempotent REST calls')
+    PARSER.add_argument('--processes', dest='PROCESSES', action='store', type=int,
+                        default=1,
+                        help='Number of image conversion processes (0 for one per core)')
+    PARSER.add_argument('--metrics', dest='METRICS', action='store',
+                        default='',
+                        help='Metrics file path, without extension (.json and .prom ' \
+                             + 'files are written; none are written by default)')
+    PARSER.add_argument('--metrics-interval', dest='METRICS_INTERVAL', action='store',
+                        type=int, default=60,
+                        help='Seconds between metrics file updates (0 to write at exit only)')
+    PARSER.add_argument('--dask-scheduler', dest='DASK_SCHEDULER', action='store',
+                        default='',
+                        help='Dask scheduler address (process samples on a Dask cluster; ' \
+                             + '--processes also needs distributed.worker.daemon: False in ' \
+                             + 'the workers\' Dask configuration)')
+    PARSER.add_argument('--dask-chunk', dest='DASK_CHUNK', action='store', type=int,
+                        default=500, help='Samples per Dask task')
     PARSER.add_argument('--write', dest='WRITE', action='store_true',
                         default=False,
                         help='Flag, Actually write to JACS (and AWS if flag set)')
@@ -941,17 +2452,25 @@ if __name__ == '__main__':
     HANDLER.setFormatter(colorlog.ColoredFormatter())
     LOGGER.addHandler(HANDLER)
 
+    RL.configure(read_timeout=ARG.TIMEOUT, retries=ARG.RETRIES,
+                 pool_size=max(10, ARG.JACS_WORKERS), cache_refresh=ARG.REFRESH_CONFIG)
     initialize_program()
     STAMP = strftime("%Y%m%dT%H%M%S")
     ERR_FILE = '%s_errors_%s.txt' % (ARG.LIBRARY, STAMP)
     ERR = open(ERR_FILE, 'w')
     S3CP_FILE = '%s_s3cp_%s.txt' % (ARG.LIBRARY, STAMP)
     S3CP = open(S3CP_FILE, 'w')
+    if ARG.RESUME or (ARG.AWS and ARG.WRITE):
+        open_journal(ARG.RESUME if ARG.RESUME else '%s_journal_%s.txt' % (ARG.LIBRARY, STAMP))
+    if ARG.METRICS:
+        MT.start(ARG.METRICS, ARG.METRICS_INTERVAL, 'upload_cdms', run_metrics)
     START_TIME = datetime.now()
     print("Processing %s on %s manifold" % (ARG.LIBRARY, ARG.MANIFOLD))
     upload_cdms_from_file()
     STOP_TIME = datetime.now()
     print("Elapsed time: %s" %  (STOP_TIME - START_TIME))
+    if STAGES:
+        print(stage_report())
     update_library_config()
     if KEY_LIST:
         KEY_FILE = '%s_keys_%s.txt' % (ARG.LIBRARY, STAMP)
@@ -964,6 +2483,8 @@ if __name__ == '__main__':
         print('Uploaded variants:')
         for key in sorted(VARIANT_UPLOADS):
             print("  %-20s %d" % (key + ':', VARIANT_UPLOADS[key]))
-    print("Server calls (excluding AWS)")
+    print("Server calls (excluding AWS and cache hits)")
     print(TRANSACTIONS)
-    terminate_program(0)
+    print(RL.report())
+    print(MT.report())
+    terminate_program(-1 if COUNT['Failed uploads'] else 0)